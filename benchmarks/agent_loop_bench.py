@@ -0,0 +1,133 @@
+"""End-to-end benchmark of the agent loop against the local mock Messages API.
+
+Run from the repo root:
+    python -m benchmarks.agent_loop_bench --sessions 32 --concurrency 8 --turns 5 --latency 0.2 --output agent_loop.json
+
+Each session is an AsyncConversation running what the chat TUI runs per
+user message: query, parse_claude_output, use_tools, and again while the
+tools produce output for the model. Sessions run concurrently on one event
+loop and share a ToolServer backed by a temporary memory DB. Embeddings
+come from the offline HashingProvider, so nothing leaves the machine.
+Reports throughput, p50/p95 per stage (see src/scaffolding/metrics.py)
+and the tool result cache's hit statistics.
+"""
+
+import argparse
+import asyncio
+import json
+import pathlib
+import tempfile
+import time
+from typing import *
+
+import anthropic
+
+from benchmarks.mock_anthropic import load_script, server_url, start_server
+from src.api import AsyncConversation, Channel
+from src.scaffolding.metrics import Metrics, metrics
+from src.scaffolding.tool_dispatcher import ToolServer
+from src.scaffolding.xml_parser import parse_claude_output
+from src.tools.memory import embedding
+from src.tools.memory.embedding import HashingProvider
+
+USER_INPUTS = [
+    "What do you remember about my preferences?",
+    "Please remember that I like green tea in the morning.",
+    "What does your source code look like?",
+    "Anything else from earlier today?",
+]
+
+
+async def collect(deltas: Optional[AsyncIterator[str]]) -> Optional[str]:
+    return None if deltas is None else "".join([delta async for delta in deltas])
+
+
+async def run_session(session: int, client: anthropic.AsyncAnthropic, tool_server: ToolServer, log_dir: pathlib.Path, args: argparse.Namespace, timings: Metrics) -> int:
+    conversation = await AsyncConversation.create(client=client, tool_server=tool_server, log_path=log_dir / f"session_{session}.jsonl")
+    requests = 0
+    for turn in range(args.turns):
+        start = time.perf_counter()
+        user_input = USER_INPUTS[turn % len(USER_INPUTS)]
+        if args.stream:
+            output = await collect(conversation.query_stream(user_input, Channel.CHAT))
+        else:
+            output = await conversation.query(user_input, Channel.CHAT)
+        requests += 1
+        # Follow tool calls until the model has nothing more to look at, like the TUI does
+        for _ in range(args.max_tool_rounds):
+            tags, _ = parse_claude_output(output)
+            if args.stream:
+                output = await collect(await conversation.use_tools_stream(tags))
+            else:
+                output = await conversation.use_tools(tags)
+            if output is None:
+                break
+            requests += 1
+        timings.record("turn", time.perf_counter() - start)
+    await conversation.close()
+    return requests
+
+
+async def run(args: argparse.Namespace, url: str, tmp: pathlib.Path) -> Dict:
+    client = anthropic.AsyncAnthropic(base_url=url, api_key="mock", max_retries=0)
+    tool_server = ToolServer(memory_db_path=tmp / "memories.sqlite")
+    timings = Metrics()
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def limited(session: int) -> int:
+        async with limit:
+            return await run_session(session, client, tool_server, tmp, args, timings)
+
+    start = time.perf_counter()
+    requests = sum(await asyncio.gather(*(limited(session) for session in range(args.sessions))))
+    seconds = time.perf_counter() - start
+    tool_cache = tool_server.result_cache.stats()
+    await asyncio.to_thread(tool_server.close)
+
+    turns = args.sessions * args.turns
+    stages = {**metrics.summary()["series"], **timings.summary()["series"]}
+    return {
+        "seconds": seconds,
+        "turns": turns,
+        "requests": requests,
+        "turns_per_second": turns / seconds,
+        "requests_per_second": requests / seconds,
+        "cache_hit_ratio": metrics.cache_hit_ratio(),
+        "tool_cache": tool_cache,
+        "stages": {name: stage for name, stage in stages.items() if not name.startswith("tokens.")},
+        "tokens": {name: stage for name, stage in stages.items() if name.startswith("tokens.")},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--turns", type=int, default=4, help="user messages per session")
+    parser.add_argument("--max-tool-rounds", type=int, default=4, help="model calls per user message spent on tool output")
+    parser.add_argument("--latency", type=float, default=0.1, help="mock seconds to the response (or first token)")
+    parser.add_argument("--chunk-latency", type=float, default=0.0, help="mock seconds between streamed deltas")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--script", type=pathlib.Path, help="JSON list of response texts")
+    parser.add_argument("--replay", type=pathlib.Path, help="chat log whose assistant messages are replayed")
+    parser.add_argument("--output", type=pathlib.Path)
+    args = parser.parse_args()
+
+    embedding.configure(new_provider=HashingProvider(), use_cache=False)
+    server, _ = start_server(load_script(args.script, args.replay), latency=args.latency, chunk_latency=args.chunk_latency)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            result = asyncio.run(run(args, server_url(server), pathlib.Path(tmp)))
+    finally:
+        server.shutdown()
+
+    result["config"] = {key: str(value) if isinstance(value, pathlib.Path) else value for key, value in vars(args).items()}
+    print(json.dumps({key: value for key, value in result.items() if key not in ("stages", "tokens")}, indent=2))
+    for name, stage in result["stages"].items():
+        print(f"{name:28} p50 {1000 * stage['p50']:8.1f}ms  p95 {1000 * stage['p95']:8.1f}ms  n={stage['count']}")
+    if args.output is not None:
+        args.output.write_text(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""Benchmarks MemoryTool as the store grows, without any network calls.
+
+Run from the repo root:
+    python -m benchmarks.memory_bench --sizes 1000 10000 100000 --output memory_bench.json
+
+For each size this builds a synthetic store (random unit embeddings, texts
+drawn from a small vocabulary so lexical search has something to match),
+then measures startup load time, save_memory/delete_memory latency,
+load_memories p50/p99 per sort mode and process RSS. Results go to stdout
+and, with --output, to a JSON file so runs can be compared across changes.
+1e6 memories at 1024 dimensions needs ~4GB as float32; use --dtype int8.
+"""
+
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import *
+from uuid import uuid4
+
+import numpy as np
+
+from src.tools.memory import SORTS, MemoryTool, embedding
+from src.tools.memory.embedding import Embedding, EmbeddingProvider
+from src.tools.memory.memory import Memory
+from src.tools.memory.storage import MemoryDB
+
+VOCABULARY = [
+    "user", "likes", "prefers", "morning", "evening", "coffee", "tea", "gym", "run", "meeting",
+    "project", "deadline", "mother", "father", "birthday", "dentist", "phone", "email", "car", "train",
+    "book", "music", "dinner", "lunch", "sleep", "work", "weekend", "travel", "budget", "doctor",
+]
+
+WRITE_CHUNK = 10_000
+
+
+class RandomProvider(EmbeddingProvider):
+    """Random unit vectors, seeded by the text so repeated texts embed identically"""
+
+    def __init__(self, dim: int) -> None:
+        self.dim = dim
+        self.model = f"benchmark-random-{dim}"
+
+    def embed(self, texts: List[str], input_type: str) -> List[Embedding]:
+        embeddings = []
+        for text in texts:
+            vector = np.random.default_rng(zlib.crc32(text.encode("utf-8"))).standard_normal(self.dim)
+            embeddings.append(vector / np.linalg.norm(vector))
+        return embeddings
+
+
+def random_text(rng: np.random.Generator) -> str:
+    words = rng.choice(VOCABULARY, size=rng.integers(5, 20))
+    return " ".join(words) + f" #{rng.integers(1_000_000)}"
+
+
+def build_store(path: Path, size: int, dim: int, dtype: str, rng: np.random.Generator) -> None:
+    db = MemoryDB(path, dtype=dtype)
+    db.check_model(embedding.provider.model)
+    start = datetime.now() - timedelta(days=365)
+    for offset in range(0, size, WRITE_CHUNK):
+        count = min(WRITE_CHUNK, size - offset)
+        vectors = rng.standard_normal((count, dim)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        db.write(inserts=[
+            Memory(
+                content=random_text(rng),
+                timestamp=start + timedelta(seconds=int(rng.integers(365 * 24 * 3600))),
+                embedding=vectors[i],
+                uuid=uuid4(),
+                importance=float(rng.random()),
+            )
+            for i in range(count)
+        ])
+    db.close()
+
+
+def percentiles(samples: List[float]) -> Dict[str, float]:
+    ms = 1000 * np.array(samples)
+    return {"p50_ms": float(np.percentile(ms, 50)), "p99_ms": float(np.percentile(ms, 99)), "mean_ms": float(ms.mean())}
+
+
+def rss_mb() -> Dict[str, float]:
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / 1024 / (1024 if platform.system() == "Darwin" else 1)
+    current_mb = None
+    statm = Path("/proc/self/statm")
+    if statm.exists():
+        current_mb = int(statm.read_text().split()[1]) * resource.getpagesize() / 1024 / 1024
+    return {"peak_rss_mb": peak_mb, "current_rss_mb": current_mb}
+
+
+def bench_size(size: int, args: argparse.Namespace, rng: np.random.Generator) -> Dict:
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "memories.sqlite"
+
+        start = time.perf_counter()
+        build_store(path, size, args.dim, args.dtype, rng)
+        build_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # Synchronous saves, so save_memory latency includes embedding and the DB write
+        tool = MemoryTool(use_ann=not args.no_ann, embedding_dtype=args.dtype, db_path=path, background_saves=False)
+        startup_seconds = time.perf_counter() - start
+
+        saves = []
+        for _ in range(args.ops):
+            text = random_text(rng)
+            start = time.perf_counter()
+            tool.save_memory(text, importance=str(rng.random()))
+            saves.append(time.perf_counter() - start)
+
+        loads = {}
+        for sort in SORTS:
+            samples = []
+            for _ in range(args.queries):
+                query = " ".join(rng.choice(VOCABULARY, size=3))
+                start = time.perf_counter()
+                tool.load_memories(query, sort=sort, limit=str(args.limit))
+                samples.append(time.perf_counter() - start)
+            loads[sort] = percentiles(samples)
+
+        deletes = []
+        live = tool.store.live_rows()
+        for row in rng.choice(live, size=min(args.ops, len(live)), replace=False):
+            uuid = str(tool.store.uuids[row])
+            start = time.perf_counter()
+            tool.delete_memory(uuid)
+            deletes.append(time.perf_counter() - start)
+
+        result = {
+            "size": size,
+            "build_seconds": build_seconds,
+            "startup_seconds": startup_seconds,
+            "db_bytes": path.stat().st_size,
+            "save_memory": percentiles(saves),
+            "delete_memory": percentiles(deletes),
+            "load_memories": loads,
+            **rss_mb(),
+        }
+        tool.close()
+        return result
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--ops", type=int, default=100, help="save and delete operations per size")
+    parser.add_argument("--queries", type=int, default=50, help="load_memories calls per sort mode per size")
+    parser.add_argument("--limit", type=int, default=15)
+    parser.add_argument("--no-ann", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    embedding.configure(new_provider=RandomProvider(args.dim), use_cache=False)
+    rng = np.random.default_rng(args.seed)
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "config": {key: str(value) if isinstance(value, Path) else value for key, value in vars(args).items()},
+        "results": [],
+    }
+    for size in args.sizes:
+        result = bench_size(size, args, rng)
+        report["results"].append(result)
+        print(json.dumps(result))
+
+    if args.output is not None:
+        args.output.write_text(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""A local stand-in for the Anthropic Messages API, for benchmarks that can't call the real one.
+
+Run from the repo root:
+    python -m benchmarks.mock_anthropic --port 8765 --latency 0.5
+and point a client at it with anthropic.AsyncAnthropic(base_url="http://127.0.0.1:8765", api_key="mock").
+
+POST /v1/messages answers with the next scripted response, as plain JSON or
+as server-sent events when the request has "stream": true. The script is
+picked by the number of assistant turns already in the request, so
+concurrent sessions each walk through it independently. It comes from a
+JSON list of strings (--script), from the assistant records of a chat log
+(--replay), or defaults to DEFAULT_SCRIPT.
+
+Token counts are estimated at 4 characters per token. Prompt caching is
+simulated: a cache_control block writes its prefix, and a later request
+with the same prefix reads it.
+"""
+
+import argparse
+import hashlib
+import json
+import pathlib
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import *
+
+# Mixes the tags the agent loop dispatches: a memory read, a memory write, a source read and plain replies
+DEFAULT_SCRIPT = [
+    '<response channel="chat">Let me look that up.</response>\n<memory_load limit="5">user preferences</memory_load>',
+    '<response channel="chat">Noted, I\'ll remember that.</response>\n<memory_save importance="0.6">The user asked about their preferences during a benchmark session.</memory_save>',
+    '<src_list></src_list>',
+    '<response channel="chat">Here is what I found in my source files.</response>',
+    '<memory_load limit="10" sort="hybrid">benchmark session</memory_load>',
+    '<response channel="chat">All done.</response>',
+]
+
+CHARS_PER_TOKEN = 4
+# Text per streamed delta
+CHUNK_CHARS = 16
+
+
+def load_script(script: Optional[pathlib.Path], replay: Optional[pathlib.Path]) -> List[str]:
+    if script is not None:
+        return json.loads(script.read_text())
+    if replay is not None:
+        with open(replay, encoding="utf-8") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+        return [record["content"] for record in records if record["role"] == "assistant"]
+    return DEFAULT_SCRIPT
+
+
+def block_text(block: Union[str, Dict]) -> str:
+    return block if isinstance(block, str) else block.get("text", "")
+
+
+class MockState:
+    """Shared by all handler threads"""
+
+    def __init__(self, script: List[str], latency: float, chunk_latency: float) -> None:
+        self.script = script
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.cached: Set[str] = set()
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def usage(self, messages: List[Dict]) -> Dict[str, int]:
+        """Splits the prompt into cache read, cache write and uncached tokens"""
+        digest = hashlib.sha256()
+        prefix_chars = 0
+        read = written = 0
+        with self.lock:
+            for message in messages:
+                content = message["content"]
+                blocks = [content] if isinstance(content, str) else content
+                for block in blocks:
+                    text = block_text(block)
+                    digest.update(text.encode("utf-8"))
+                    prefix_chars += len(text)
+                    if isinstance(block, dict) and "cache_control" in block:
+                        key = digest.hexdigest()
+                        if key in self.cached:
+                            read = prefix_chars
+                        else:
+                            self.cached.add(key)
+                            written = prefix_chars
+            self.requests += 1
+        written = max(0, written - read)
+        return {
+            "input_tokens": max(0, prefix_chars - read - written) // CHARS_PER_TOKEN,
+            "cache_read_input_tokens": read // CHARS_PER_TOKEN,
+            "cache_creation_input_tokens": written // CHARS_PER_TOKEN,
+        }
+
+    def reply(self, messages: List[Dict]) -> str:
+        turn = sum(1 for message in messages if message["role"] == "assistant")
+        return self.script[turn % len(self.script)]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    state: MockState
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    def do_POST(self) -> None:
+        if not self.path.startswith("/v1/messages"):
+            self.send_error(404)
+            return
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        text = self.state.reply(request["messages"])
+        usage = {**self.state.usage(request["messages"]), "output_tokens": len(text) // CHARS_PER_TOKEN + 1}
+        message = {
+            "id": f"msg_mock_{uuid.uuid4().hex}",
+            "type": "message",
+            "role": "assistant",
+            "model": request["model"],
+            "content": [{"type": "text", "text": text}],
+            "stop_reason": "end_turn",
+            "stop_sequence": None,
+            "usage": usage,
+        }
+
+        time.sleep(self.state.latency)
+        if request.get("stream"):
+            self.stream(message, text)
+        else:
+            body = json.dumps(message).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def event(self, name: str, data: Dict) -> None:
+        self.wfile.write(f"event: {name}\ndata: {json.dumps(data)}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def stream(self, message: Dict, text: str) -> None:
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+
+        usage = message["usage"]
+        self.event("message_start", {"type": "message_start", "message": {**message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}}})
+        self.event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}})
+        for start in range(0, len(text), CHUNK_CHARS):
+            time.sleep(self.state.chunk_latency)
+            self.event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text[start : start + CHUNK_CHARS]}})
+        self.event("content_block_stop", {"type": "content_block_stop", "index": 0})
+        self.event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": usage["output_tokens"]}})
+        self.event("message_stop", {"type": "message_stop"})
+
+
+def start_server(script: List[str], port: int = 0, latency: float = 0.0, chunk_latency: float = 0.0) -> Tuple[ThreadingHTTPServer, MockState]:
+    """Serves on a daemon thread. Port 0 picks a free port: see server.server_address."""
+    state = MockState(script, latency, chunk_latency)
+    handler = type("Handler", (MockHandler,), {"state": state})
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="mock-anthropic", daemon=True).start()
+    return server, state
+
+
+def server_url(server: ThreadingHTTPServer) -> str:
+    host, port = server.server_address[:2]
+    return f"http://{host}:{port}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds before the response (or its first token)")
+    parser.add_argument("--chunk-latency", type=float, default=0.0, help="seconds between streamed deltas")
+    parser.add_argument("--script", type=pathlib.Path, help="JSON list of response texts")
+    parser.add_argument("--replay", type=pathlib.Path, help="chat log whose assistant messages are replayed")
+    args = parser.parse_args()
+
+    server, _ = start_server(load_script(args.script, args.replay), args.port, args.latency, args.chunk_latency)
+    print(f"Mock Messages API on {server_url(server)}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
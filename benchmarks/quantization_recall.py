@@ -0,0 +1,62 @@
+"""Recall of quantized embedding storage against exact float32 relevance scores.
+
+Run from the repo root:
+    python -m benchmarks.quantization_recall --n 20000 --dim 1024
+
+Uses synthetic clustered unit vectors, so no embedding API is needed.
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from src.tools.memory.quantize import EMBEDDING_DTYPES, dot, encode
+
+
+def synthetic_embeddings(n: int, dim: int, clusters: int, rng: np.random.Generator) -> np.ndarray:
+    centers = rng.standard_normal((clusters, dim))
+    embeddings = centers[rng.integers(0, clusters, n)] + 0.7 * rng.standard_normal((n, dim))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings.astype(np.float32)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    embeddings = synthetic_embeddings(args.n, args.dim, args.clusters, rng)
+    queries = embeddings[rng.integers(0, args.n, args.queries)] + 0.3 * rng.standard_normal((args.queries, args.dim)).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+
+    exact = [set(np.argsort(-(embeddings @ query))[: args.k]) for query in queries]
+
+    results = {"n": args.n, "dim": args.dim, "k": args.k, "dtypes": {}}
+    for dtype in EMBEDDING_DTYPES:
+        codes, scales = encode(embeddings, dtype)
+        recall = 0.0
+        start = time.perf_counter()
+        for query, truth in zip(queries, exact):
+            top = np.argsort(-dot(codes, scales, query))[: args.k]
+            recall += len(truth.intersection(top)) / args.k
+        elapsed = time.perf_counter() - start
+
+        results["dtypes"][dtype] = {
+            "recall_at_k": recall / len(queries),
+            "bytes_per_row": codes.itemsize * args.dim + (4 if scales is not None else 0),
+            "ms_per_query": 1000 * elapsed / len(queries),
+        }
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,14 @@
 import anthropic
+import asyncio
 import dotenv
 import pathlib
+import time
 from typing import *
 from datetime import datetime
 
 from src.core_prompts.prompts import load_system_prompt
+from src.scaffolding.chat_log import ChatLog, read_log
+from src.scaffolding.metrics import metrics
 from src.scaffolding.status import basic_status
 from src.scaffolding.tool_dispatcher import ToolServer
 from src.scaffolding.xml_parser import ParsedTag
@@ -12,90 +16,306 @@ from src.utils import ROOT
 
 dotenv.load_dotenv()
 
-client = anthropic.Anthropic()
 claude_model = "claude-3-5-sonnet-20241022"
 # claude_model = "claude-3-5-sonnet-20240620"
 max_tokens_per_message = 8192
+chat_log_dir = ROOT / "data" / "chat_storage"
+
+# Context accounting. Token counts come from response.usage where we have them,
+# and are estimated at chars_per_token for messages the model hasn't seen yet
+default_context_window = 200_000
+default_compact_threshold = 0.75
+keep_recent_messages = 8
+max_tokens_per_summary = 2048
+chars_per_token = 4
+# The API allows this many cache_control blocks per request
+max_cache_breakpoints = 4
+
+summary_prompt = """Below is an earlier stretch of your conversation, which is being removed to save context space. Summarize it for your future self: what the user asked for, what you did and found, decisions made, and anything still unfinished. Keep names, numbers, ids and file paths exact. Reply with only the summary.
+
+<conversation>
+{conversation}
+</conversation>"""
 
 
 def message_from_text(text: str) -> Dict:
     return {"role": "user", "content": [{"type": "text", "text": text}]}
 
 
+def message_text(message: Dict) -> str:
+    return "\n".join(block["text"] for block in message["content"])
+
+
+def estimate_tokens(message: Dict) -> int:
+    return len(message_text(message)) // chars_per_token + 1
+
+
+def input_tokens(usage) -> int:
+    # With prompt caching, the prompt is split between these three counts
+    return usage.input_tokens + (getattr(usage, "cache_creation_input_tokens", None) or 0) + (getattr(usage, "cache_read_input_tokens", None) or 0)
+
+
 class Channel:
     CHAT = (0,)
     SMS = 1
 
 
-class Conversation:
+class AsyncConversation:
+    """The conversation engine. Model calls and tool runs are awaited, so several
+    conversations (or a conversation and a UI) can share one event loop."""
     messages: List[Dict]
+    # Parallel to messages: measured token counts, or estimates for the ones after `measured`
+    message_tokens: List[int]
+    measured: int
+    # Messages before this (system prompt, status and startup memories) are never compacted
+    prefix_length: int
+    # Cache breakpoints: fixed ones in the prefix, plus the end of the previous request if it's still there
+    prefix_breakpoints: List[int]
+    previous_request_end: Optional[int]
+    # Per response: input, cache_read, cache_write and output tokens
+    turn_usage: List[Dict[str, int]]
     tool_server: ToolServer
-    chat_storage: pathlib.Path
+    log: ChatLog
+    client: anthropic.AsyncAnthropic
+
+    def __init__(self, with_system_prompt: bool = True, client: Optional[anthropic.AsyncAnthropic] = None, context_window: int = default_context_window, compact_threshold: float = default_compact_threshold, resume_from: Optional[pathlib.Path] = None, tool_server: Optional[ToolServer] = None, log_path: Optional[pathlib.Path] = None) -> None:
+        """Use `await AsyncConversation.create(...)`, which also runs the startup in start().
 
-    def __init__(self, with_system_prompt: bool = True) -> None:
+        resume_from is the log of an earlier session to pick up, instead of starting from the system prompt.
+        A tool_server passed in can be shared between conversations, and is left open by close()."""
         self.messages = []
-        self.tool_server = ToolServer()
+        self.prefix_breakpoints = []
+        self.previous_request_end = None
+        self.turn_usage = []
+        self.message_tokens = []
+        self.measured = 0
+        self.with_system_prompt = with_system_prompt
+        self.context_window = context_window
+        self.compact_threshold = compact_threshold
+        self.resume_from = resume_from
+        self.log_path = log_path
+        self.client = client if client is not None else anthropic.AsyncAnthropic()
+        self.owns_tool_server = tool_server is None
+        self.tool_server = tool_server if tool_server is not None else ToolServer()
+    
+    @classmethod
+    async def create(cls, **kwargs: Any) -> "AsyncConversation":
+        conversation = cls(**kwargs)
+        await conversation.start()
+        return conversation
+    
+    async def start(self) -> None:
+        """Builds the prompt prefix, or replays the resumed log. The startup memory_load (which may also
+        load the memory store) runs on a worker thread, so other coroutines on the loop keep going."""
+        if self.resume_from is not None:
+            self._replay(await asyncio.to_thread(read_log, self.resume_from))
+            self.log = ChatLog(self.resume_from)
+            return
         
         now = datetime.now()
-        self.chat_storage = ROOT / "data" / "chat_storage" / f"{now.month}_{now.day}_{now.year}__{now.hour}:{now.minute}:{now.second}.txt"
+        self.log = ChatLog(self.log_path if self.log_path is not None else chat_log_dir / f"{now.month}_{now.day}_{now.year}__{now.hour}:{now.minute}:{now.second}.jsonl")
 
-        if with_system_prompt:
+        if self.with_system_prompt:
             system_prompt = load_system_prompt()
             system_message = message_from_text(system_prompt)
-            system_message["content"][0]["cache_control"] = {"type": "ephemeral"}
-            self.messages.append(system_message)
-
-            status = basic_status()
-            status_message = message_from_text(status)
-            self.messages.append(status_message)
+            self._append(system_message, "system")
             
-            self.messages.append({
+            self._append({
                 "role": "assistant",
                 "content":
                     [{"type": "text", "text": 'Let me check my memories. \n<memory_load limit="15" sort="date"></memory_load>'}]
-            })
+            }, "assistant")
             
             
-            (memory_response, _) = self.tool_server.use_tools([ParsedTag(tag="memory_load", attributes={"limit": "15", "sort": "date"}, content=" ")])
-            with open(self.chat_storage, "a+") as f:
-                f.write(memory_response)
+            (memory_response, _) = await self.tool_server.ause_tools([ParsedTag(tag="memory_load", attributes={"limit": "15", "sort": "date"}, content=" ")])
             memory_message = message_from_text(memory_response)
-            memory_response
-            memory_message["content"][0]["cache_control"] = {"type": "ephemeral"}
-            self.messages.append(memory_message)
+            self._append(memory_message, "tool", informational=True)
+            
+            # The prompt rarely changes and the memories only change when saved, so both are cached.
+            # The status has the current time in it, so it comes after them
+            self.prefix_breakpoints = [0, len(self.messages) - 1]
+
+            status = basic_status()
+            status_message = message_from_text(status)
+            self._append(status_message, "status")
+            
+        self.prefix_length = len(self.messages)
+        # Everything a resume needs to lay out the prefix and its cache breakpoints the same way
+        self.log.write("session", "", prefix_length=self.prefix_length, prefix_breakpoints=self.prefix_breakpoints)
+            
+    def _append(self, message: Dict, log_role: str, **log_fields: Any) -> None:
+        self.messages.append(message)
+        self.message_tokens.append(estimate_tokens(message))
+        self.log.write(log_role, message_text(message), **log_fields)
+        
+    def _replay(self, records: List[Dict]) -> None:
+        # Rebuilds messages exactly as they were sent, so the first request after a resume
+        # has the same prefix (and cache breakpoints) as the last one before it
+        if not any(record["role"] == "session" for record in records):
+            raise ValueError("Can't resume from a log without a session record")
+        for record in records:
+            role = record["role"]
+            if role == "session":
+                self.prefix_length = record["prefix_length"]
+                self.prefix_breakpoints = record["prefix_breakpoints"]
+            elif role == "error":
+                # Written on shutdown, never sent to the model
+                continue
+            elif role == "summary":
+                end = self.prefix_length + record["replaced"]
+                self.messages[self.prefix_length:end] = [message_from_text(record["content"])]
+                self.message_tokens[self.prefix_length:end] = [estimate_tokens(self.messages[self.prefix_length])]
+            else:
+                message = {"role": "assistant" if role == "assistant" else "user", "content": [{"type": "text", "text": record["content"]}]}
+                self.messages.append(message)
+                self.message_tokens.append(estimate_tokens(message))
+        
+        # The last request before the restart wrote the cache up to the message before its response
+        replies = [i for i, message in enumerate(self.messages) if message["role"] == "assistant" and i >= self.prefix_length]
+        if len(replies) > 0:
+            self.previous_request_end = replies[-1] - 1
+        
+    def context_tokens(self) -> int:
+        """Size of the next request, measured up to the last response and estimated after it"""
+        return sum(self.message_tokens)
+    
+    def _measure(self, usage) -> None:
+        # The API only reports the whole prompt, so spread the unmeasured part over
+        # the unmeasured messages in proportion to their estimates
+        unmeasured = input_tokens(usage) - sum(self.message_tokens[:self.measured])
+        estimates = self.message_tokens[self.measured:]
+        total = sum(estimates)
+        if total > 0 and unmeasured > 0:
+            self.message_tokens[self.measured:] = [max(1, round(unmeasured * estimate / total)) for estimate in estimates]
+        self.measured = len(self.messages)
+        
+    def cache_plan(self) -> List[int]:
+        """Indexes of the messages to mark with cache_control in the next request (at most max_cache_breakpoints).
+
+        The last message is written to the cache so the next turn can read it, and the end of the
+        previous request is kept so this turn reads what the last one wrote.
+        """
+        rolling = {i for i in (self.previous_request_end, len(self.messages) - 1) if i is not None and i >= self.prefix_length}
+        return self.prefix_breakpoints + sorted(rolling)[-(max_cache_breakpoints - len(self.prefix_breakpoints)):]
+    
+    def _request_messages(self) -> List[Dict]:
+        plan = self.cache_plan()
+        self.previous_request_end = len(self.messages) - 1
+        messages = list(self.messages)
+        for i in plan:
+            # Copies, so the cache_control markers don't pile up in the history
+            blocks = list(messages[i]["content"])
+            blocks[-1] = {**blocks[-1], "cache_control": {"type": "ephemeral"}}
+            messages[i] = {**messages[i], "content": blocks}
+        return messages
+    
+    def cache_hit_rate(self) -> float:
+        """Fraction of all prompt tokens so far that were read from the cache"""
+        total = sum(turn["input"] + turn["cache_read"] + turn["cache_write"] for turn in self.turn_usage)
+        return sum(turn["cache_read"] for turn in self.turn_usage) / total if total > 0 else 0.0
+        
+    async def _maybe_compact(self) -> None:
+        if self.context_tokens() <= self.compact_threshold * self.context_window:
+            return
+        end = len(self.messages) - keep_recent_messages
+        if end - self.prefix_length < 2:
+            return
+        await self.compact(end)
+        
+    async def compact(self, end: int) -> None:
+        """Replaces messages[prefix_length:end] with a model-written summary. The prefix, and with it the prompt cache, is untouched."""
+        old = self.messages[self.prefix_length:end]
+        conversation = "\n\n".join(f"{message['role']}: {message_text(message)}" for message in old)
+        with metrics.timer("api.compaction"):
+            response = await self.client.messages.create(
+                model=claude_model,
+                max_tokens=max_tokens_per_summary,
+                messages=[message_from_text(summary_prompt.format(conversation=conversation))],
+            )
+        summary = message_from_text(f'<system type="scaffolding">Summary of the earlier conversation, compacted to save space:\n{response.content[0].text}</system>')
+        
+        self.messages[self.prefix_length:end] = [summary]
+        self.message_tokens[self.prefix_length:end] = [estimate_tokens(summary)]
+        # Everything after the prefix gets re-measured by the next response, and re-cached
+        self.measured = min(self.measured, self.prefix_length)
+        self.previous_request_end = None
+        self.log.write("summary", message_text(summary), replaced=end - self.prefix_length)
             
+    async def close(self) -> None:
+        # The log is flushed even when closing the tool server raises, e.g. with a failed background memory save
+        try:
+            if self.owns_tool_server:
+                await asyncio.to_thread(self.tool_server.close)
+        except Exception as e:
+            self.log.write("error", str(e), tool="memory_save")
+            raise
+        finally:
+            self.log.close()
+            metrics.dump(self.log.path.with_suffix(".metrics.json"))
             
-    def _send_and_receive(self) -> str:
-        response = client.beta.prompt_caching.messages.create(
+    async def _send_and_receive(self) -> str:
+        await self._maybe_compact()
+        start = time.perf_counter()
+        response = await self.client.messages.create(
             model=claude_model,
             max_tokens=max_tokens_per_message,
-            messages=self.messages,
+            messages=self._request_messages(),
             
         )
 
         if response.type == "error":
             raise "API ERROR!"
         elif response.type == "message":
-            content = response.content
-            self.messages.append(
-                {
-                    "role": "assistant",
-                    "content": [
-                        {"type": "text", "text": block.text} for block in content
-                    ],
-                }
-            )
-            assert len(content) == 1
-            response_text = content[0].text
-            with open(self.chat_storage, "a+") as f:
-                f.write(response_text+ "\n")
-                
-            return response_text
-
-    # TODO: Add support for images
-    # TODO: Add handling for running out of tokens
-    # TODO: Handle running out of API Credits
-    def query(self, user_content: str, channel: Channel) -> str:
+            return self._record_response(response, latency=time.perf_counter() - start)
+        
+    async def _stream_and_receive(self) -> AsyncIterator[str]:
+        await self._maybe_compact()
+        start = time.perf_counter()
+        first_token_latency = None
+        async with self.client.messages.stream(
+            model=claude_model,
+            max_tokens=max_tokens_per_message,
+            messages=self._request_messages(),
+        ) as stream:
+            async for text in stream.text_stream:
+                if first_token_latency is None:
+                    first_token_latency = time.perf_counter() - start
+                yield text
+            response = await stream.get_final_message()
+        
+        # Only the finished message goes into the history and the log
+        self._record_response(response, latency=time.perf_counter() - start, first_token_latency=first_token_latency)
+        
+    def _record_response(self, response, latency: float, first_token_latency: Optional[float] = None) -> str:
+        content = response.content
+        self._measure(response.usage)
+        self.turn_usage.append({
+            "input": response.usage.input_tokens,
+            "cache_read": getattr(response.usage, "cache_read_input_tokens", None) or 0,
+            "cache_write": getattr(response.usage, "cache_creation_input_tokens", None) or 0,
+            "output": response.usage.output_tokens,
+        })
+        metrics.record_usage(self.turn_usage[-1])
+        metrics.record("api.latency", latency)
+        if first_token_latency is not None:
+            metrics.record("api.first_token_latency", first_token_latency)
+        assert len(content) == 1
+        self._append(
+            {
+                "role": "assistant",
+                "content": [
+                    {"type": "text", "text": block.text} for block in content
+                ],
+            },
+            "assistant", usage=self.turn_usage[-1], latency=latency, first_token_latency=first_token_latency,
+        )
+        self.message_tokens[-1] = response.usage.output_tokens
+        self.measured = len(self.messages)
+        response_text = content[0].text
+            
+        return response_text
+    
+    def _add_user_input(self, user_content: str, channel: Channel) -> None:
         if channel == Channel.CHAT:
             channel = "chat"
         elif channel == Channel.SMS:
@@ -103,12 +323,18 @@ class Conversation:
 
         user_content = f"<user_input channel={channel}>{user_content}</user_input>"
 
-        self.messages.append(message_from_text(user_content))
-        
-        with open(self.chat_storage, "a") as f:
-            f.write(user_content+ "\n")
+        self._append(message_from_text(user_content), "user", channel=channel)
 
-        return self._send_and_receive()
+    # TODO: Add support for images
+    # TODO: Handle running out of API Credits
+    async def query(self, user_content: str, channel: Channel) -> str:
+        self._add_user_input(user_content, channel)
+        return await self._send_and_receive()
+    
+    def query_stream(self, user_content: str, channel: Channel) -> AsyncIterator[str]:
+        """Like query, but yields the response text as it's generated. The message is recorded once the stream is exhausted."""
+        self._add_user_input(user_content, channel)
+        return self._stream_and_receive()
 
     def last_assistant_block(self) -> List[Dict]:
         messages = []
@@ -122,14 +348,10 @@ class Conversation:
                 messages.insert(0, message)
         return messages
     
-    def use_tools(self, tool_calls: List[ParsedTag]) -> Optional[str]:
-        # If the tools provide system responses to be processed by 
-        # the assistant, this will call the tools, call the model,
-        # and then finally return the new response.
-        # If none of the tools need to be looked at, simply processes the 
-        # tool calls and returns None
+    async def _add_tool_results(self, tool_calls: List[ParsedTag]) -> bool:
+        # Returns whether the model needs to be called to look at the results
         
-        (info_msgs, success_messages) = self.tool_server.use_tools(tool_calls)
+        (info_msgs, success_messages) = await self.tool_server.ause_tools(tool_calls)
         
         # Handle informational responses right away
         # Success messages are more complicated: If there are no info messages, bundle them with the next user query. If there are info messages, you might as well send them now
@@ -139,18 +361,84 @@ class Conversation:
             if success_messages is not None:
                 info_msgs += success_messages
                 
-            # Temp storage
-            with open(self.chat_storage, "a+") as f:
-                f.write(info_msgs + "\n")
-                
-            self.messages.append(message_from_text(info_msgs))
-            return self._send_and_receive()
+            self._append(message_from_text(info_msgs), "tool", informational=True)
+            return True
         else: 
             # No informational messages to handle
             if success_messages is not None:
-                # Temp storage
-                with open(self.chat_storage, "a+") as f:
-                    f.write(success_messages + "\n")
-                    
                 # Add this message but don't send it yet. It will be bundled with the next call
-                self.messages.append(message_from_text(success_messages))
+                self._append(message_from_text(success_messages), "tool", informational=False)
+            return False
+    
+    async def use_tools(self, tool_calls: List[ParsedTag]) -> Optional[str]:
+        # If the tools provide system responses to be processed by 
+        # the assistant, this will call the tools, call the model,
+        # and then finally return the new response.
+        # If none of the tools need to be looked at, simply processes the 
+        # tool calls and returns None
+        if await self._add_tool_results(tool_calls):
+            return await self._send_and_receive()
+        return None
+    
+    async def use_tools_stream(self, tool_calls: List[ParsedTag]) -> Optional[AsyncIterator[str]]:
+        """Like use_tools, but streams the model's response to the tool results"""
+        if await self._add_tool_results(tool_calls):
+            return self._stream_and_receive()
+        return None
+
+
+class Conversation:
+    """Blocking wrapper around AsyncConversation, which it drives on its own event loop"""
+
+    def __init__(self, with_system_prompt: bool = True, client: Optional[anthropic.AsyncAnthropic] = None, context_window: int = default_context_window, compact_threshold: float = default_compact_threshold, resume_from: Optional[pathlib.Path] = None) -> None:
+        self.runner = asyncio.Runner()
+        self.conversation = self.runner.run(AsyncConversation.create(with_system_prompt=with_system_prompt, client=client, context_window=context_window, compact_threshold=compact_threshold, resume_from=resume_from))
+        
+    @property
+    def messages(self) -> List[Dict]:
+        return self.conversation.messages
+    
+    @property
+    def tool_server(self) -> ToolServer:
+        return self.conversation.tool_server
+    
+    @property
+    def log(self) -> ChatLog:
+        return self.conversation.log
+    
+    def close(self) -> None:
+        try:
+            self.runner.run(self.conversation.close())
+        finally:
+            self.runner.close()
+        
+    def _iterate(self, deltas: AsyncIterator[str]) -> Iterator[str]:
+        async def next_delta() -> str:
+            return await deltas.__anext__()
+        while True:
+            try:
+                yield self.runner.run(next_delta())
+            except StopAsyncIteration:
+                return
+        
+    def query(self, user_content: str, channel: Channel) -> str:
+        return self.runner.run(self.conversation.query(user_content, channel))
+    
+    def query_stream(self, user_content: str, channel: Channel) -> Iterator[str]:
+        return self._iterate(self.conversation.query_stream(user_content, channel))
+    
+    def last_assistant_block(self) -> List[Dict]:
+        return self.conversation.last_assistant_block()
+    
+    def context_tokens(self) -> int:
+        return self.conversation.context_tokens()
+    
+    def cache_hit_rate(self) -> float:
+        return self.conversation.cache_hit_rate()
+    
+    def use_tools(self, tool_calls: List[ParsedTag]) -> Optional[str]:
+        return self.runner.run(self.conversation.use_tools(tool_calls))
+    
+    def use_tools_stream(self, tool_calls: List[ParsedTag]) -> Optional[Iterator[str]]:
+        deltas = self.runner.run(self.conversation.use_tools_stream(tool_calls))
+        return None if deltas is None else self._iterate(deltas)
@@ -0,0 +1,62 @@
+import json
+import pathlib
+import threading
+from datetime import datetime
+from typing import *
+
+# Seconds between background flushes
+FLUSH_INTERVAL = 1.0
+
+
+class ChatLog:
+    """Append-only JSONL log of a conversation, one record per message.
+
+    write() only buffers, so the request path never touches the disk. The
+    file is opened once, and the buffer is flushed by a background thread
+    every FLUSH_INTERVAL seconds and on flush()/close().
+    """
+
+    def __init__(self, path: pathlib.Path, flush_interval: float = FLUSH_INTERVAL) -> None:
+        self.path = path
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+        self.buffer: List[str] = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self._flush_periodically, args=(flush_interval,), name="chat-log", daemon=True)
+        self.flusher.start()
+
+    def write(self, role: str, content: str, **fields: Any) -> None:
+        """Buffers a record. Extra fields (channel, usage, latency, ...) are stored as given."""
+        record = {"time": datetime.now().isoformat(), "role": role, "content": content, **fields}
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self.lock:
+            self.buffer.append(line)
+
+    def flush(self) -> None:
+        with self.lock:
+            lines, self.buffer = self.buffer, []
+            if len(lines) > 0 and not self.file.closed:
+                self.file.write("".join(lines))
+                self.file.flush()
+
+    def _flush_periodically(self, interval: float) -> None:
+        while not self.closed.wait(interval):
+            self.flush()
+
+    def close(self) -> None:
+        self.closed.set()
+        self.flusher.join()
+        self.flush()
+        self.file.close()
+
+
+def read_log(path: pathlib.Path) -> List[Dict]:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def latest_log(directory: pathlib.Path) -> Optional[pathlib.Path]:
+    logs = list(directory.glob("*.jsonl"))
+    return max(logs, key=lambda path: path.stat().st_mtime) if len(logs) > 0 else None
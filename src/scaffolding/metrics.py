@@ -0,0 +1,100 @@
+import functools
+import json
+import pathlib
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import *
+
+# Aggregates cover the most recent samples of each series
+WINDOW = 500
+PERCENTILES = (50, 95)
+
+
+def percentile(values: Sequence[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q / 100 * len(ordered)))]
+
+
+class Metrics:
+    """Rolling windows of named measurements: latencies in seconds, token counts per turn.
+
+    Series are named like "api.latency", "tokens.cache_read" or "tool.memory_load".
+    Safe to record from tool worker threads.
+    """
+
+    def __init__(self, window: int = WINDOW) -> None:
+        self.window = window
+        self.series: Dict[str, Deque[float]] = {}
+        self.totals: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def record(self, name: str, value: float) -> None:
+        with self.lock:
+            if name not in self.series:
+                self.series[name] = deque(maxlen=self.window)
+            self.series[name].append(value)
+            self.totals[name] = self.totals.get(name, 0.0) + value
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name: str) -> Callable:
+        """Decorator version of timer"""
+        def decorator(function: Callable) -> Callable:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.timer(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record_usage(self, usage: Dict[str, int]) -> None:
+        for kind, tokens in usage.items():
+            self.record(f"tokens.{kind}", tokens)
+
+    def cache_hit_ratio(self) -> float:
+        """Share of recent prompt tokens that were read from the cache"""
+        with self.lock:
+            read = sum(self.series.get("tokens.cache_read", []))
+            prompt = read + sum(self.series.get("tokens.cache_write", [])) + sum(self.series.get("tokens.input", []))
+        return read / prompt if prompt > 0 else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        with self.lock:
+            series = {name: list(values) for name, values in self.series.items()}
+            totals = dict(self.totals)
+        aggregates = {}
+        for name, values in sorted(series.items()):
+            aggregates[name] = {
+                "count": len(values),
+                "mean": sum(values) / len(values),
+                **{f"p{q}": percentile(values, q) for q in PERCENTILES},
+                "total": totals[name],
+            }
+        return {"cache_hit_ratio": self.cache_hit_ratio(), "series": aggregates}
+
+    def dump(self, path: pathlib.Path) -> None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(self.summary(), indent=2))
+
+    def report(self) -> str:
+        """Human readable summary, as shown by the TUI's /metrics command"""
+        summary = self.summary()
+        lines = [f"Cache hit ratio: {summary['cache_hit_ratio']:.1%}"]
+        for name, aggregate in summary["series"].items():
+            if name.startswith("tokens."):
+                lines.append(f"{name}: {aggregate['mean']:.0f}/turn (p95 {aggregate['p95']:.0f}, total {aggregate['total']:.0f})")
+            else:
+                lines.append(f"{name}: p50 {1000 * aggregate['p50']:.0f}ms, p95 {1000 * aggregate['p95']:.0f}ms (n={aggregate['count']})")
+        return "\n".join(lines)
+
+
+# Shared by the conversation, the tool server and the parser
+metrics = Metrics()
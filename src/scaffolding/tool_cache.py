@@ -0,0 +1,121 @@
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from typing import *
+
+from src.scaffolding.tool_plan import overlaps
+from src.scaffolding.xml_parser import ParsedTag
+
+# Results kept across turns, least recently used dropped first
+CACHE_ENTRIES = 256
+
+Key = Tuple[str, Tuple[Tuple[str, str], ...], str]
+
+
+def cache_key(tag: ParsedTag) -> Key:
+    return (tag.tag, tuple(sorted(tag.attributes.items())), tag.content)
+
+
+@dataclass
+class CacheEntry:
+    stamp: Hashable
+    reads: Set[str]
+    output: Optional[str]
+
+
+class ToolResultCache:
+    """Outputs of read-only tool calls, keyed by tag and attributes.
+
+    An entry is only used while the stamp of its call (e.g. mtime and size of the file it reads) still
+    matches. Writes through the tools drop the entries whose reads they overlap right away, since a quick
+    write can leave mtime and size as they were. Identical calls running at the same time share one run.
+    Failed calls aren't cached. Safe to use from tool worker threads.
+    """
+
+    def __init__(self, max_entries: int = CACHE_ENTRIES) -> None:
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Key, CacheEntry]" = OrderedDict()
+        self.pending: Dict[Key, Future] = {}
+        # Bumped by invalidate, so runs that started before a write don't store what they read
+        self.generation = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Misses because the stamp changed
+        self.stale = 0
+        self.deduplicated = 0
+        self.invalidated = 0
+
+    def get_or_run(self, tag: ParsedTag, stamp: Callable[[], Hashable], reads: Set[str], run: Callable[[], Optional[str]]) -> Optional[str]:
+        key = cache_key(tag)
+        # Stamped before running, so a change during the run makes the next call miss
+        current = stamp()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry.stamp == current:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry.output
+            if entry is not None:
+                del self.entries[key]
+                self.stale += 1
+            future = self.pending.get(key)
+            if future is not None:
+                self.deduplicated += 1
+                running = False
+            else:
+                future = Future()
+                self.pending[key] = future
+                generation = self.generation
+                self.misses += 1
+                running = True
+        if not running:
+            return future.result()
+
+        try:
+            output = run()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                if self.pending.get(key) is future:
+                    del self.pending[key]
+        with self.lock:
+            if generation == self.generation:
+                self.entries[key] = CacheEntry(current, reads, output)
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        future.set_result(output)
+        return output
+
+    def invalidate(self, writes: Set[str]) -> None:
+        """Drops the entries that read anything under the written resources"""
+        if len(writes) == 0:
+            return
+        with self.lock:
+            self.generation += 1
+            for key in [key for key, entry in self.entries.items() if overlaps(entry.reads, writes)]:
+                del self.entries[key]
+                self.invalidated += 1
+            # Later calls start a fresh run instead of joining one that may have read the old contents
+            self.pending.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses + self.deduplicated
+            return {
+                "entries": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "deduplicated": self.deduplicated,
+                "invalidated": self.invalidated,
+                "hit_ratio": (self.hits + self.deduplicated) / lookups if lookups > 0 else 0.0,
+            }
+
+    def report(self) -> str:
+        stats = self.stats()
+        return f"Tool cache: {stats['hit_ratio']:.1%} hit ratio ({stats['hits']} hits, {stats['deduplicated']} deduplicated, {stats['misses']} misses, {stats['stale']} stale, {stats['invalidated']} invalidated, {stats['entries']} entries)"
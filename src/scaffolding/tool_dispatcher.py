@@ -1,21 +1,55 @@
+import asyncio
+import pathlib
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from typing import *
 
-from src.tools.memory import MemoryTool
-from src.tools.source import SourceTool
-from src.tools.files import FilesTool
-from src.tools.update_core_prompt import UpdateCorePromptTool
-
+from src.scaffolding.metrics import metrics
+from src.scaffolding.tool_cache import ToolResultCache, cache_key
+from src.scaffolding.tool_plan import plan_tool_calls
+from src.scaffolding.tool_registry import TOOL_FACTORIES, TOOLS
 from src.scaffolding.xml_parser import ParsedTag
 
+if TYPE_CHECKING:
+    from src.tools.memory import MemoryTool
+
+# Tool calls from one response that can run at once
+TOOL_WORKERS = 8
+
 class ToolServer:
-    def __init__(self) -> None:
-        self.memory_tool: MemoryTool = MemoryTool()
-        self.source_tool: SourceTool = SourceTool()
-        self.files_tool: FilesTool = FilesTool()
-        self.update_core_prompt_tool: UpdateCorePromptTool = UpdateCorePromptTool()
+    def __init__(self, memory_db_path: Optional[pathlib.Path] = None) -> None:
+        self.memory_db_path = memory_db_path
+        # Built on first use (see TOOL_FACTORIES), so a session only pays for the tools it touches
+        self._tools: Dict[str, Any] = {}
+        self._tools_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=TOOL_WORKERS, thread_name_prefix="tool")
+        # Outputs of read-only tags that have a stamp (see ToolSpec.stamp)
+        self.result_cache = ToolResultCache()
+        
+    def tool(self, name: str) -> Any:
+        tool = self._tools.get(name)
+        if tool is None:
+            # Tools run on worker threads, so two calls could race to build the same one
+            with self._tools_lock:
+                tool = self._tools.get(name)
+                if tool is None:
+                    tool = TOOL_FACTORIES[name](self)
+                    self._tools[name] = tool
+        return tool
+    
+    @property
+    def memory_tool(self) -> "MemoryTool":
+        return self.tool("memory")
+        
+    def close(self) -> None:
+        # Stops the tool workers. Queued memory saves run on MemoryTool's own pool, and tool.close() waits for them
+        self._executor.shutdown()
+        for tool in self._tools.values():
+            if hasattr(tool, "close"):
+                tool.close()
         
     def use_tools(self, tools: List[ParsedTag]) -> Tuple[Optional[str], Optional[str]]:
-        """Uses the given tools, and returns all of the outcomes
+        """Uses the given tools, and returns all of the outcomes. Blocking version of ause_tools, for callers without an event loop.
 
         Arguments:
             tools -- A list of tags to be dispatched
@@ -23,11 +57,54 @@ class ToolServer:
         Returns:
             (informational_messages, simple_success_messages). Every tool has a success message when it completes, but not all are informational. By default, all informational messages and all errors should be returned to the agent immediately. Simple success messages can instead be returned at the next user query time.
         """
+        return asyncio.run(self.ause_tools(tools))
+        
+    async def ause_tools(self, tools: List[ParsedTag]) -> Tuple[Optional[str], Optional[str]]:
+        """Independent tools run at the same time on the worker pool, conflicting ones in order (see plan_tool_calls).
+        The event loop only waits, so file and embedding I/O don't block it. Returns what use_tools does."""
+        loop = asyncio.get_running_loop()
+        with metrics.timer("tools.turn"):
+            outcomes: Dict[int, Tuple[bool, str]] = {}
+            saves: List[Future] = []
+            for wave in plan_tool_calls(tools):
+                for unit_outcomes in await asyncio.gather(*(loop.run_in_executor(self._executor, self._use_unit, tools, unit, saves) for unit in wave)):
+                    outcomes.update(unit_outcomes)
+            return self._collect_outcomes(tools, outcomes)
+        
+    def _use_unit(self, tools: List[ParsedTag], unit: List[int], saves: List[Future]) -> Dict[int, Tuple[bool, str]]:
+        # saves collects the Futures of this response's memory_saves. The plan already runs them before any later
+        # memory tag, but they return once queued, so a load that only sees embedded memories waits for them.
+        tag = tools[unit[0]]
+        if tag.tag == "memory_save":
+            return dict(zip(unit, self.use_memory_saves([tools[i] for i in unit], saves)))
+        if tag.tag == "memory_load" and len(saves) > 0 and not self.memory_tool.sees_queued_saves(tag.attributes.get("sort")):
+            # Failed saves are reported through pop_save_errors
+            with metrics.timer("tool.memory_save_wait"):
+                wait(saves)
+        return {unit[0]: self.use_tool(tag)}
+        
+    def _collect_outcomes(self, tools: List[ParsedTag], outcomes: Dict[int, Tuple[bool, str]]) -> Tuple[Optional[str], Optional[str]]:
+        # Messages always come back in the order the tags were given
         informational_messages = ""
         simple_success_messages = ""
         
-        for tool in tools:
-            has_info, out = self.use_tool(tool)
+        # Saves embed in the background, so their failures surface on a later turn
+        save_errors = self._tools["memory"].pop_save_errors() if "memory" in self._tools else []
+        for error in save_errors:
+            informational_messages += f'<system type="memory_save" status="error">{error}</system>\n'
+        
+        # Identical reads in one response ran once; their output is only sent the first time
+        sent: Dict[Tuple, str] = {}
+        for i in range(len(tools)):
+            has_info, out = outcomes[i]
+            spec = TOOLS.get(tools[i].tag)
+            success = f'<system type="{tools[i].tag}" status="success">'
+            if spec is not None and spec.stamp is not None and out.startswith(success):
+                key = cache_key(tools[i])
+                if sent.get(key) == out:
+                    out = f'{success}Same as the identical {tools[i].tag} above</system>'
+                else:
+                    sent[key] = out
             if has_info:
                 informational_messages += out
                 informational_messages += "\n"
@@ -35,38 +112,54 @@ class ToolServer:
                 simple_success_messages += out
                 simple_success_messages += "\n"
                 
-        informational_messages = informational_messages if informational_messages is not "" else None
-        simple_success_messages = simple_success_messages if simple_success_messages is not "" else None
+        informational_messages = informational_messages if informational_messages != "" else None
+        simple_success_messages = simple_success_messages if simple_success_messages != "" else None
         
         return (informational_messages, simple_success_messages)
         
-        
     def use_tool(self, tag: ParsedTag) -> Tuple[bool, str]:
         """Returns the output of a call, and whether it needs to be parsed immediately. The bool should be true for informative outputs and errors. An empty success message should be false, and will only be surfaced as needed."""
         try:
-            output = self._try_use_tool(tag)
-            return (output is not None, f'<system type="{tag.tag}" status="success">{output if output is not None else ""}</system>')
+            with metrics.timer(f"tool.{tag.tag}"):
+                output = self._try_use_tool(tag)
+            return (TOOLS[tag.tag].informational, f'<system type="{tag.tag}" status="success">{output if output is not None else ""}</system>')
         except Exception as e:
             return (True, f'<system type="{tag.tag}" status="error">{e}</system>')
         
+    def use_memory_saves(self, tags: List[ParsedTag], saves: Optional[List[Future]] = None) -> List[Tuple[bool, str]]:
+        """Saves several memory_save tags at once. Returns the same outputs use_tool would have, one per tag,
+        and adds the Future of the save to saves."""
+        try:
+            with metrics.timer("tool.memory_save" if len(tags) == 1 else "tool.memory_save_batch"):
+                future = self.memory_tool.save_memories(
+                    texts=[tag.content for tag in tags],
+                    importances=[tag.attributes["importance"] for tag in tags],
+                )
+        except Exception as e:
+            if len(tags) == 1:
+                return [(True, f'<system type="memory_save" status="error">{e}</system>')]
+            # Nothing was queued, so fall back to one at a time and let only the bad tags fail
+            return [outcome for tag in tags for outcome in self.use_memory_saves([tag], saves)]
+        if saves is not None:
+            saves.append(future)
+        return [(False, '<system type="memory_save" status="success"></system>') for _ in tags]
+        
     def _try_use_tool(self, tag: ParsedTag) -> Optional[str]:
-        if tag.tag == "memory_load":
-            return self.memory_tool.load_memories(query=tag.content, **tag.attributes)
-        elif tag.tag == "memory_save":
-            return self.memory_tool.save_memory(text=tag.content, **tag.attributes)
-        elif tag.tag == "memory_delete":
-            return self.memory_tool.delete_memory(uuid=tag.attributes["id"])
-        elif tag.tag == "src_read":
-            return self.source_tool.read_src(**tag.attributes)
-        elif tag.tag == "src_list":
-            return self.source_tool.list_src(**tag.attributes)
-        elif tag.tag == "file_write":
-            self.files_tool.write_file(content=tag.content, **tag.attributes)
-        elif tag.tag == "file_read":
-            return self.files_tool.read_file(**tag.attributes)
-        elif tag.tag == "file_list":
-            return self.files_tool.list_files(**tag.attributes)
-        elif tag.tag == "update_core_prompt":  # Add this section
-            return self.update_core_prompt_tool.execute(content=tag.content, **tag.attributes)
-        else:
-            raise NotImplementedError
\ No newline at end of file
+        spec = TOOLS.get(tag.tag)
+        if spec is None:
+            raise NotImplementedError(f"Unknown tool {tag.tag}")
+        tool = self.tool(spec.tool)
+        if spec.stamp is not None:
+            return self.result_cache.get_or_run(
+                tag,
+                stamp=lambda: spec.stamp(tool, tag),
+                reads=spec.resources(tag)[0],
+                run=lambda: spec.handler(tool, tag),
+            )
+        if spec.read_only:
+            return spec.handler(tool, tag)
+        try:
+            return spec.handler(tool, tag)
+        finally:
+            # Even a failed write may have changed something
+            self.result_cache.invalidate(spec.resources(tag)[1])
@@ -0,0 +1,65 @@
+from typing import *
+
+from src.scaffolding.tool_registry import TOOLS
+from src.scaffolding.xml_parser import ParsedTag
+
+# A unit is a list of tag indexes that run as one call: a single tag, or a batch of memory_saves
+Unit = List[int]
+
+
+def tool_resources(tag: ParsedTag) -> Tuple[Set[str], Set[str]]:
+    """(reads, writes) of a tag, from the registry. Resources are paths like "memory", "src" or "files/notes/a.txt",
+    and a path covers everything under it, so a file_list of a directory conflicts with writes inside it."""
+    spec = TOOLS.get(tag.tag)
+    return spec.resources(tag) if spec is not None else (set(), set())
+
+
+def overlaps(a: Set[str], b: Set[str]) -> bool:
+    return any(x == y or x.startswith(y + "/") or y.startswith(x + "/") for x in a for y in b)
+
+
+def make_units(tags: List[ParsedTag]) -> List[Unit]:
+    # memory_save tags are held back and run as one batch (one embedding request,
+    # one DB write) right before the next tag that touches memory, or at the end
+    units: List[Unit] = []
+    pending_saves: Unit = []
+    for i, tag in enumerate(tags):
+        if tag.tag == "memory_save":
+            pending_saves.append(i)
+            continue
+        if tag.tag.startswith("memory_") and len(pending_saves) > 0:
+            units.append(pending_saves)
+            pending_saves = []
+        units.append([i])
+    if len(pending_saves) > 0:
+        units.append(pending_saves)
+    return units
+
+
+def plan_tool_calls(tags: List[ParsedTag]) -> List[List[Unit]]:
+    """Splits the tags of one response into waves. Units within a wave don't conflict and can run at
+    the same time; each wave starts after the one before it. A unit conflicts with an earlier one
+    when either writes something the other reads or writes, and always lands in a later wave."""
+    units = make_units(tags)
+    resources = []
+    for unit in units:
+        reads, writes = set(), set()
+        for i in unit:
+            unit_reads, unit_writes = tool_resources(tags[i])
+            reads |= unit_reads
+            writes |= unit_writes
+        resources.append((reads, writes))
+
+    levels: List[int] = []
+    for u, (reads, writes) in enumerate(resources):
+        level = 0
+        for v in range(u):
+            earlier_reads, earlier_writes = resources[v]
+            if overlaps(earlier_writes, reads | writes) or overlaps(earlier_reads, writes):
+                level = max(level, levels[v] + 1)
+        levels.append(level)
+
+    waves: List[List[Unit]] = [[] for _ in range(max(levels, default=-1) + 1)]
+    for unit, level in zip(units, levels):
+        waves[level].append(unit)
+    return waves
@@ -0,0 +1,155 @@
+import pathlib
+import posixpath
+from dataclasses import dataclass
+from typing import *
+
+from src.scaffolding.xml_parser import ParsedTag
+
+Resources = Tuple[Set[str], Set[str]]
+
+
+@dataclass(frozen=True)
+class ToolSpec:
+    """How the ToolServer handles one tag"""
+    # Key of the tool instance in TOOL_FACTORIES, built on first use
+    tool: str
+    handler: Callable[[Any, ParsedTag], Optional[str]]
+    # (reads, writes) of a call, used to order conflicting calls (see tool_plan.py)
+    resources: Callable[[ParsedTag], Resources]
+    # Changes nothing, so it can run alongside anything that doesn't write what it reads
+    read_only: bool
+    # Running it twice in a row gives the same result as running it once
+    idempotent: bool
+    # The output goes back to the model right away, instead of with the next user message
+    informational: bool
+    # What the output of a read-only call depends on, like the mtime and size of the file it reads.
+    # Tags with one have their results cached by the ToolServer (see tool_cache.py)
+    stamp: Optional[Callable[[Any, ParsedTag], Hashable]] = None
+
+
+# Factories get the ToolServer, for its settings
+def make_memory_tool(server: Any) -> Any:
+    from src.tools.memory import MemoryTool
+    return MemoryTool(db_path=server.memory_db_path)
+
+
+def make_source_tool(server: Any) -> Any:
+    from src.tools.source import SourceTool
+    return SourceTool()
+
+
+def make_files_tool(server: Any) -> Any:
+    from src.tools.files import FilesTool
+    return FilesTool()
+
+
+def make_update_core_prompt_tool(server: Any) -> Any:
+    from src.tools.update_core_prompt import UpdateCorePromptTool
+    return UpdateCorePromptTool()
+
+
+# Imports happen inside the factories, so e.g. numpy and the memory DB are only loaded by sessions that use memory
+TOOL_FACTORIES: Dict[str, Callable[[Any], Any]] = {
+    "memory": make_memory_tool,
+    "source": make_source_tool,
+    "files": make_files_tool,
+    "update_core_prompt": make_update_core_prompt_tool,
+}
+
+
+def files_resource(path: Optional[str]) -> str:
+    normalized = posixpath.normpath(path or ".")
+    return "files" if normalized == "." else f"files/{normalized}"
+
+
+def path_stamp(path: pathlib.Path) -> Optional[Tuple[int, int]]:
+    # A directory's mtime changes when entries are added, removed or renamed in it, which covers a (non-recursive) listing
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def source_stamp(tool: Any, tag: ParsedTag) -> Hashable:
+    return path_stamp(tool.source_path / tag.attributes.get("path", ""))
+
+
+def files_stamp(tool: Any, tag: ParsedTag) -> Hashable:
+    return path_stamp((tool.base_path / (tag.attributes.get("path") or "")).resolve())
+
+
+def save_memory(tool: Any, tag: ParsedTag) -> None:
+    # The save finishes in the background; failures are reported through MemoryTool.pop_save_errors
+    tool.save_memory(text=tag.content, **tag.attributes)
+
+
+def reads(resource: str) -> Callable[[ParsedTag], Resources]:
+    return lambda tag: ({resource}, set())
+
+
+def writes(resource: str) -> Callable[[ParsedTag], Resources]:
+    return lambda tag: (set(), {resource})
+
+
+TOOLS: Dict[str, ToolSpec] = {
+    "memory_load": ToolSpec(
+        tool="memory",
+        handler=lambda tool, tag: tool.load_memories(query=tag.content, **tag.attributes),
+        resources=reads("memory"),
+        read_only=True, idempotent=True, informational=True,
+    ),
+    "memory_save": ToolSpec(
+        tool="memory",
+        handler=save_memory,
+        resources=writes("memory"),
+        read_only=False, idempotent=False, informational=False,
+    ),
+    "memory_delete": ToolSpec(
+        tool="memory",
+        handler=lambda tool, tag: tool.delete_memory(uuid=tag.attributes["id"]),
+        resources=writes("memory"),
+        read_only=False, idempotent=True, informational=True,
+    ),
+    "src_read": ToolSpec(
+        tool="source",
+        handler=lambda tool, tag: tool.read_src(**tag.attributes),
+        resources=reads("src"),
+        read_only=True, idempotent=True, informational=True,
+        stamp=source_stamp,
+    ),
+    "src_list": ToolSpec(
+        tool="source",
+        handler=lambda tool, tag: tool.list_src(**tag.attributes),
+        resources=reads("src"),
+        read_only=True, idempotent=True, informational=True,
+        stamp=source_stamp,
+    ),
+    "file_write": ToolSpec(
+        tool="files",
+        handler=lambda tool, tag: tool.write_file(content=tag.content, **tag.attributes),
+        resources=lambda tag: (set(), {files_resource(tag.attributes.get("path"))}),
+        read_only=False, idempotent=False, informational=False,
+    ),
+    "file_read": ToolSpec(
+        tool="files",
+        handler=lambda tool, tag: tool.read_file(**tag.attributes),
+        resources=lambda tag: ({files_resource(tag.attributes.get("path"))}, set()),
+        read_only=True, idempotent=True, informational=True,
+        stamp=files_stamp,
+    ),
+    "file_list": ToolSpec(
+        tool="files",
+        handler=lambda tool, tag: tool.list_files(**tag.attributes),
+        resources=lambda tag: ({files_resource(tag.attributes.get("path"))}, set()),
+        read_only=True, idempotent=True, informational=True,
+        stamp=files_stamp,
+    ),
+    "update_core_prompt": ToolSpec(
+        tool="update_core_prompt",
+        handler=lambda tool, tag: tool.execute(content=tag.content, **tag.attributes),
+        # The core prompts live under src, where src_read can see them
+        resources=writes("src"),
+        read_only=False, idempotent=False, informational=False,
+    ),
+}
@@ -7,6 +7,8 @@ from xml.sax.saxutils import escape, unescape
 from io import StringIO
 import xml.etree.ElementTree as ET
 
+from src.scaffolding.metrics import metrics
+
 
 @dataclass
 class ParsedTag:
@@ -119,6 +121,7 @@ def escape_non_xml(text: str) -> str:
     return processed_text
 
 
+@metrics.timed("parse")
 def parse_claude_output(text: str) -> Tuple[List[ParsedTag], Optional[str]]:
     """
     Parse text containing XML tags, handling both well-formed XML and text with random angle brackets.
@@ -6,8 +6,7 @@ class FilesTool:
     def __init__(self) -> None:
         # Base path for all file operations - this would be set to the reserved folder
         self.base_path = ROOT / "data" / "files"
-        
-        self.write_file(content="blah", path="test.txt")
+        self.base_path.mkdir(parents=True, exist_ok=True)
     
     def write_file(self, path: str, content: str, mode: str = "overwrite") -> None:
         """Write content to a file in the reserved directory"""
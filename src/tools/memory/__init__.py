@@ -1,70 +1,392 @@
+import functools
 import pathlib
-import pickle as pkl
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from dataclasses import replace
+from datetime import datetime
 from typing import *
-from uuid import UUID
+from uuid import UUID, uuid4
 
-from .memory import Memory, make_memory, relevance_scores, time_score
+import numpy as np
+
+from . import embedding
+from .embedding import embed_memories
+from .index import IVFIndex
+from .lexical import BM25Index
+from .memory import Memory, query_embedding, relevance_scores
+from .scoring import IMPORTANCE_WEIGHT, RECENCY_WEIGHT, RELEVANCE_WEIGHT, combined_scores, top_k
+from .storage import MemoryDB
 from .xml import make_xml
 
-IMPORTANCE_WEIGHT = 0.1
-RECENCY_WEIGHT = 0.2
-RELEVANCE_WEIGHT = 1.0
+# How embeddings are kept in RAM and on disk: "float32" | "float16" | "int8" (see quantize.py)
+EMBEDDING_DTYPE = "float32"
+
+# A new memory this similar to an existing one is merged into it instead of being saved again
+DUPLICATE_THRESHOLD = 0.95
+# How much a merge raises the surviving memory's importance (capped at 1)
+DUPLICATE_IMPORTANCE_BUMP = 0.05
+
+# Reciprocal rank fusion for sort="hybrid": score = sum of 1 / (RRF_K + rank) over the lexical and vector rankings
+RRF_K = 60
+# How deep each ranking is read for fusion, as a multiple of the limit
+RRF_DEPTH = 4
+
+SORTS = ("relevance", "date", "combined", "lexical", "hybrid")
+DEFAULT_SORT = "combined"
+# These only see a save once it's embedded and committed; date and lexical loads also see queued saves
+EMBEDDED_SORTS = ("relevance", "combined", "hybrid")
+
+# Threads embedding and persisting saves in the background. Commits still happen one at a time.
+SAVE_WORKERS = 2
+# Default memory_load budget, so a large limit of long memories can't flood the context
+LOAD_MAX_TOKENS = 4000
+
+
+def locked(method):
+    # The store, DB and indexes are shared with the background save workers
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class MemoryTool():
-    def __init__(self) -> None:
-        self.db_path = pathlib.Path(__file__).with_name("memories.pkl")
-        with open(self.db_path, "rb+") as f:
+    def __init__(
+        self,
+        use_ann: bool = True,
+        embedding_dtype: str = EMBEDDING_DTYPE,
+        db_path: Optional[pathlib.Path] = None,
+        background_saves: bool = True,
+    ) -> None:
+        self.db_path = db_path or pathlib.Path(__file__).with_name("memories.sqlite")
+        self.db = MemoryDB(self.db_path, legacy_path=self.db_path.with_name("memories.pkl"), dtype=embedding_dtype)
+        self.db.check_model(embedding.provider.model)
+        self.store = self.db.load()
+        
+        # Approximate search over the embeddings. Tune recall vs latency with self.index.nprobe
+        self.index: Optional[IVFIndex] = None
+        if use_ann:
+            self.index = IVFIndex()
+            self.index.size = self.store.size
+            self.index.maybe_train(self.store.embeddings, self.store.alive)
+        
+        # Built on the first lexical/hybrid load, then kept up to date
+        self._lexical: Optional[BM25Index] = None
+        
+        # Saves are embedded and persisted by worker threads. Until then they wait in _pending
+        # (without an embedding), where date and lexical loads can still see them.
+        self._lock = threading.RLock()
+        self._pending: Dict[UUID, Memory] = {}
+        self._futures: Set[Future] = set()
+        self.save_errors: List[Exception] = []
+        self._executor = ThreadPoolExecutor(max_workers=SAVE_WORKERS, thread_name_prefix="memory-save") if background_saves else None
+    
+    @property
+    def lexical(self) -> BM25Index:
+        if self._lexical is None:
+            self._lexical = BM25Index()
+            for row in self.store.live_rows():
+                self._lexical.add(self.store.uuids[row], self.store.contents[row])
+            for memory in self._pending.values():
+                self._lexical.add(memory.uuid, memory.content)
+        return self._lexical
+    
+    def save_memory(self, text: str, importance: str) -> Future:
+        return self.save_memories([text], [importance])
+        
+    def save_memories(self, texts: List[str], importances: List[str]) -> Future:
+        """Queues memories to be embedded (in one request) and committed (in one transaction).
+
+        Returns right away unless background saves are off. Bad arguments still raise here.
+        """
+        now = datetime.now()
+        memories = [
+            Memory(content=text, timestamp=now, embedding=[], uuid=uuid4(), importance=float(importance))
+            for text, importance in zip(texts, importances)
+        ]
+        with self._lock:
+            for memory in memories:
+                self._pending[memory.uuid] = memory
+                if self._lexical is not None:
+                    self._lexical.add(memory.uuid, memory.content)
+        
+        if self._executor is None:
+            future = Future()
+            future.set_result(self._commit(memories))
+            return future
+        
+        future = self._executor.submit(self._commit, memories)
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._finished)
+        return future
+    
+    @staticmethod
+    def sees_queued_saves(sort: Optional[str] = None) -> bool:
+        """Whether a load with this sort already sees saves that are still being embedded"""
+        return (sort or DEFAULT_SORT) not in EMBEDDED_SORTS
+    
+    def _finished(self, future: Future):
+        with self._lock:
+            self._futures.discard(future)
+            if future.exception() is not None:
+                self.save_errors.append(future.exception())
+    
+    def pop_save_errors(self) -> List[Exception]:
+        """Errors from background saves that finished since the last call"""
+        with self._lock:
+            errors, self.save_errors = self.save_errors, []
+        return errors
+    
+    def flush(self, timeout: Optional[float] = None) -> None:
+        """Waits for every queued save to be committed, then raises the first background error, if any"""
+        with self._lock:
+            futures = list(self._futures)
+        wait(futures, timeout=timeout)
+        errors = self.pop_save_errors()
+        if len(errors) > 0:
+            raise errors[0]
+    
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            self.db.close()
+    
+    def _commit(self, pending: List[Memory]) -> None:
+        # The network call happens outside the lock, so loads aren't blocked on it
+        try:
+            embeddings = embed_memories([memory.content for memory in pending])
+        except Exception:
+            with self._lock:
+                self._drop_pending([memory.uuid for memory in pending])
+            raise
+        
+        with self._lock:
+            # Anything deleted while it was being embedded is no longer pending
+            memories = [replace(memory, embedding=embed) for memory, embed in zip(pending, embeddings) if memory.uuid in self._pending]
             try:
-                self.db: List[Memory] = pkl.load(f)
-            except EOFError:
-                self.db: List[Memory] = []
-                                            
-    def _save(self):
-        with open(self.db_path, "wb") as f:
-            pkl.dump(self.db, f)
-    
-    def save_memory(self, text: str, importance: str):
-        memory = make_memory(text, float(importance))
-        self.db.append(memory)
-        self._save()
+                self._commit_embedded(memories)
+            finally:
+                # Committed memories keep their lexical entry under the same UUID; merged or failed ones lose it
+                for memory in pending:
+                    if self.store.find(memory.uuid) is not None:
+                        self._pending.pop(memory.uuid, None)
+                    else:
+                        self._drop_pending([memory.uuid])
+    
+    def _drop_pending(self, uuids: List[UUID]):
+        for uuid in uuids:
+            self._pending.pop(uuid, None)
+            if self._lexical is not None:
+                self._lexical.remove(uuid)
+    
+    def _commit_embedded(self, memories: List[Memory]) -> None:
+        # Near-duplicates (of stored memories, or of each other) are merged instead of appended
+        new: List[Memory] = []
+        merged: Dict[int, Tuple[float, float]] = {}  # row -> (importance, timestamp)
+        for memory in memories:
+            query_embed = np.asarray(memory.embedding, dtype=np.float32)
+            row, score = self._most_similar(query_embed)
+            if row is not None and score >= DUPLICATE_THRESHOLD:
+                importance = merged.get(row, (self.store.importances[row],))[0]
+                merged[row] = (merge_importance(importance, memory.importance), memory.timestamp.timestamp())
+                continue
+            
+            earlier = [i for i, other in enumerate(new) if float(np.dot(other.embedding, query_embed)) >= DUPLICATE_THRESHOLD]
+            if len(earlier) > 0:
+                new[earlier[0]].importance = merge_importance(new[earlier[0]].importance, memory.importance)
+                continue
+            new.append(memory)
+        
+        updates = [(self.store.uuids[row], importance, timestamp) for row, (importance, timestamp) in merged.items()]
+        
+        # Persist first, so the in-memory store never holds something the DB doesn't
+        self.db.write(inserts=new, updates=updates)
+        for row, (importance, timestamp) in merged.items():
+            self.store.update(row, importance=importance, timestamp=timestamp)
+        for memory in new:
+            row = self.store.append(memory)
+            if self.index is not None:
+                self.index.add(row, self.store.embedding(row))
+        if self.index is not None:
+            self.index.maybe_train(self.store.embeddings, self.store.alive)
+    
+    def _score(self, query_embed: np.ndarray, limit: int = 1) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Relevance of the rows worth scoring for a query: (rows, relevances, alive). Holds at least `limit` live rows when the store does."""
+        # The ANN index narrows the rows worth scoring. None means exact search over every row.
+        candidates = self.index.search(query_embed, limit=limit) if self.index is not None else None
+        
+        if candidates is None:
+            relevances = relevance_scores(query_embed, self.store.embeddings, self.store.scales)
+            return np.arange(self.store.size), relevances, self.store.alive
+        
+        scales = self.store.scales[candidates] if self.store.scales is not None else None
+        relevances = relevance_scores(query_embed, self.store.embeddings[candidates], scales)
+        return candidates, relevances, self.store.alive[candidates]
+    
+    def _most_similar(self, query_embed: np.ndarray) -> Tuple[Optional[int], float]:
+        if len(self.store) == 0:
+            return None, -np.inf
+        rows, relevances, alive = self._score(query_embed)
+        # The candidates can still hold no live row, e.g. after deletes. That's no duplicate.
+        if not alive.any():
+            return None, -np.inf
+        relevances = np.where(alive, relevances, -np.inf)
+        best = int(np.argmax(relevances))
+        return int(rows[best]), float(relevances[best])
         
     def delete_memory(self, uuid: str) -> bool:
         # Returns true if a memory was successfully deleted
-        uuid = UUID(hex=uuid)
-        for i, mem in enumerate(self.db):
-            if mem.uuid == uuid:
-                del self.db[i]
-                self._save()
-                return True
-        return False
+        return self.delete_memories([uuid]) == 1
     
-    def load_memories(self, query: str, sort: str = "combined", limit: str = "5") -> str:
+    @locked
+    def delete_memories(self, uuids: List[str]) -> int:
+        # Deletes in one transaction, costing O(k) for k ids. Returns how many memories were deleted.
+        uuids = list(dict.fromkeys(UUID(hex=uuid) for uuid in uuids))
         
-        if len(self.db) == 0:
-            return "No memories yet saved"
+        # Saves still being embedded are just dropped, and their commit will skip them
+        cancelled = [uuid for uuid in uuids if uuid in self._pending]
+        self._drop_pending(cancelled)
         
-        relevances = relevance_scores(query, self.db)
+        found = [uuid for uuid in uuids if self.store.find(uuid) is not None]
+        if len(found) == 0:
+            return len(cancelled)
+        self.db.write(deletes=found)
+        self._remove(found)
+        return len(found) + len(cancelled)
+    
+    def _remove(self, uuids: List[UUID]):
+        for uuid in uuids:
+            row = self.store.remove(uuid)
+            if row is not None and self.index is not None:
+                self.index.remove(row)
+            if self._lexical is not None:
+                self._lexical.remove(uuid)
         
-        if sort == "relevance":
-            sorted_mems = sorted(self.db, key=lambda mem: relevances[mem.uuid], reverse=True)
-        elif sort == "date":
-            sorted_mems = sorted(self.db, key=lambda mem: mem.timestamp, reverse=True)
-        elif sort == "combined":
-            sorted_mems = sorted(self.db, key=lambda mem: 
-                (IMPORTANCE_WEIGHT * mem.importance) 
-                + (RECENCY_WEIGHT * time_score(mem)) 
-                + (RELEVANCE_WEIGHT * relevances[mem.uuid]), 
-                reverse=True
-            )
-        else:
-            raise f"{sort} is an invalid argument!"
+        if self.store.needs_compaction:
+            self._compact()
+    
+    @locked
+    def consolidate(self, threshold: float = DUPLICATE_THRESHOLD) -> int:
+        """Offline pass that merges near-duplicate memories across the whole store. Returns how many were merged away.
+
+        Each cluster is kept as its most important (then most recent) memory, with the merged importance and latest timestamp.
+        Costs one similarity search per surviving memory, so it's much faster with the ANN index active.
+        """
+        rows = self.store.live_rows()
+        order = rows[np.lexsort((-self.store.timestamps[rows], -self.store.importances[rows]))]
+        # Rows already merged away, or already kept as a cluster's survivor. Candidate sets from the ANN index
+        # aren't symmetric, so a later, less important row could otherwise absorb an earlier survivor.
+        handled = np.zeros(self.store.size, dtype=bool)
+        
+        merged: Dict[int, Tuple[float, float]] = {}
+        duplicates: List[UUID] = []
+        for row in order:
+            if handled[row]:
+                continue
+            handled[row] = True
+            candidates, relevances, alive = self._score(self.store.embedding(row))
+            dupes = candidates[alive & ~handled[candidates] & (relevances >= threshold)]
+            if len(dupes) == 0:
+                continue
             
-        result = sorted_mems[:int(limit)]
+            handled[dupes] = True
+            importance = self.store.importances[row]
+            for dupe in dupes:
+                importance = merge_importance(importance, self.store.importances[dupe])
+            merged[row] = (importance, max(self.store.timestamps[row], self.store.timestamps[dupes].max()))
+            duplicates.extend(self.store.uuids[dupe] for dupe in dupes)
         
-        return make_xml(result, relevances=relevances)
+        if len(duplicates) == 0:
+            return 0
+        self.db.write(
+            updates=[(self.store.uuids[row], importance, timestamp) for row, (importance, timestamp) in merged.items()],
+            deletes=duplicates,
+        )
+        for row, (importance, timestamp) in merged.items():
+            self.store.update(row, importance=importance, timestamp=timestamp)
+        self._remove(duplicates)
+        return len(duplicates)
     
-            
+    def _compact(self):
+        keep = self.store.compact()
+        if self.index is not None:
+            self.index.compact(keep)
     
+    @locked
+    def load_memories(self, query: str, sort: str = DEFAULT_SORT, limit: str = "5", max_tokens: str = str(LOAD_MAX_TOKENS), max_chars: Optional[str] = None) -> str:
+        
+        if len(self.store) == 0 and len(self._pending) == 0:
+            return "No memories yet saved"
+        
+        if sort not in SORTS:
+            raise ValueError(f"{sort} is an invalid argument!")
+        
+        limit = int(limit)
+        render = functools.partial(make_xml, max_tokens=int(max_tokens), max_chars=None if max_chars is None else int(max_chars))
+        
+        # Date order doesn't depend on the query, so don't pay for an embedding
+        if sort == "date":
+            rows = self._top_live(self.store.timestamps, self.store.alive, limit)
+            memories = self.store.memories(rows) + list(self._pending.values())
+            memories = sorted(memories, key=lambda memory: memory.timestamp, reverse=True)[:limit]
+            return render(memories, relevances=None)
+        
+        # Keyword match only: no embedding call
+        if sort == "lexical":
+            memories = [
+                self._pending[uuid] if uuid in self._pending else self.store.memory(self.store.find(uuid))
+                for uuid, _ in self.lexical.search(query, limit=limit)
+            ]
+            return render(memories, relevances=None)
+        
+        if len(self.store) == 0:
+            return "No memories yet saved"
+        
+        query_embed = query_embedding(query)
+        
+        if sort == "hybrid":
+            rows = self._hybrid(query, query_embed, limit)
+            relevances = relevance_scores(query_embed, self.store.embeddings[rows], self.store.scales[rows] if self.store.scales is not None else None)
+            return render(self.store.memories(rows), relevances=relevances)
+        candidates, relevances, alive = self._score(query_embed, limit=limit)
+        
+        if sort == "relevance":
+            scores = relevances
+        else:
+            scores = combined_scores(self.store.importances[candidates], self.store.timestamps[candidates], relevances)
             
+        # Only the rows that get rendered are turned back into Memory objects
+        top = self._top_live(scores, alive, limit)
+        rows = candidates[top]
+        
+        return render(self.store.memories(rows), relevances=relevances[top])
     
+    def _hybrid(self, query: str, query_embed: np.ndarray, limit: int) -> np.ndarray:
+        # Reciprocal rank fusion of the lexical and vector rankings
+        depth = RRF_DEPTH * limit
+        candidates, relevances, alive = self._score(query_embed, limit=depth)
+        vector_rows = candidates[self._top_live(relevances, alive, depth)]
+        lexical_rows = [self.store.find(uuid) for uuid, _ in self.lexical.search(query, limit=depth) if uuid not in self._pending]
+        
+        fused: Dict[int, float] = {}
+        for ranking in (vector_rows, lexical_rows):
+            for rank, row in enumerate(ranking):
+                fused[int(row)] = fused.get(int(row), 0.0) + 1.0 / (RRF_K + rank + 1)
         
+        return np.array(sorted(fused, key=fused.get, reverse=True)[:limit], dtype=np.intp)
+    
+    def _top_live(self, scores: np.ndarray, alive: np.ndarray, limit: int) -> np.ndarray:
+        # Like top_k, but never picks tombstoned rows
+        if self.store.deleted == 0:
+            return top_k(scores, limit)
+        scores = np.where(alive, scores, -np.inf)
+        return top_k(scores, min(limit, int(np.count_nonzero(alive))))
+
+
+def merge_importance(existing: float, new: float) -> float:
+    return min(1.0, max(existing, new) + DUPLICATE_IMPORTANCE_BUMP)
@@ -0,0 +1,86 @@
+import hashlib
+import pathlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import *
+
+import numpy as np
+
+DEFAULT_LRU_SIZE = 1024
+
+
+class EmbeddingCache:
+    """Two-tier cache for embeddings: a bounded in-memory LRU in front of an SQLite table.
+
+    Entries are keyed by (model, input_type, sha256(text)), so the same text
+    embedded as a query and as a document never collide, and a model change
+    naturally misses. Safe to share between threads.
+    """
+
+    def __init__(self, path: pathlib.Path, lru_size: int = DEFAULT_LRU_SIZE) -> None:
+        self.path = path
+        self.lru_size = lru_size
+        self.lru: OrderedDict[str, List[float]] = OrderedDict()
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)"
+            )
+
+    @staticmethod
+    def key(model: str, input_type: str, text: str) -> str:
+        digest = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        return f"{model}:{input_type}:{digest}"
+
+    def _remember(self, key: str, embedding: List[float]) -> None:
+        self.lru[key] = embedding
+        self.lru.move_to_end(key)
+        if len(self.lru) > self.lru_size:
+            self.lru.popitem(last=False)
+
+    def get(self, model: str, input_type: str, text: str) -> Optional[List[float]]:
+        key = self.key(model, input_type, text)
+        with self.lock:
+            return self._get(key)
+
+    def _get(self, key: str) -> Optional[List[float]]:
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            self.memory_hits += 1
+            return self.lru[key]
+
+        row = self.conn.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        embedding = np.frombuffer(row[0], dtype=np.float32).tolist()
+        self._remember(key, embedding)
+        self.disk_hits += 1
+        return embedding
+
+    def put(self, model: str, input_type: str, text: str, embedding: List[float]) -> None:
+        key = self.key(model, input_type, text)
+        with self.lock:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO embeddings VALUES (?, ?)",
+                    (key, np.asarray(embedding, dtype=np.float32).tobytes()),
+                )
+            self._remember(key, embedding)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "lru_entries": len(self.lru),
+        }
@@ -0,0 +1,19 @@
+"""Merges near-duplicate memories across the whole store.
+
+Run from the repo root, ideally while no conversation is open:
+    python -m src.tools.memory.consolidate --threshold 0.95
+"""
+
+import argparse
+
+from . import DUPLICATE_THRESHOLD, MemoryTool
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threshold", type=float, default=DUPLICATE_THRESHOLD)
+    args = parser.parse_args()
+
+    tool = MemoryTool()
+    before = len(tool.store)
+    merged = tool.consolidate(threshold=args.threshold)
+    print(f"Merged {merged} of {before} memories into near-duplicates, {len(tool.store)} remain")
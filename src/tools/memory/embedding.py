@@ -1,13 +1,142 @@
-import voyageai
+import os
+import pathlib
+import threading
+import zlib
+import dotenv
 import numpy as np
-from typing import List
+from typing import List, Optional
 
-vo = voyageai.Client()
+from .cache import EmbeddingCache
+
+dotenv.load_dotenv()
 
 type Embedding = List[float]
 
+
+class EmbeddingProvider:
+    """Turns texts into embeddings. `model` names the embedding space, and is part of the cache key."""
+    model: str
+
+    def embed(self, texts: List[str], input_type: str) -> List[Embedding]:
+        raise NotImplementedError
+
+
+class VoyageProvider(EmbeddingProvider):
+    def __init__(self, model: str = "voyage-3") -> None:
+        self.model = model
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use, so importing this module needs neither network nor an API key
+        if self._client is None:
+            import voyageai
+            self._client = voyageai.Client()
+        return self._client
+
+    def embed(self, texts: List[str], input_type: str) -> List[Embedding]:
+        return self.client.embed(texts, model=self.model, input_type=input_type).embeddings
+
+
+class HashingProvider(EmbeddingProvider):
+    """Offline embeddings from hashed word and character n-gram counts.
+
+    No network and no model weights, so it's good for tests, benchmarks and
+    deployments that can't afford the remote call. It only captures lexical
+    overlap, not meaning.
+    """
+
+    def __init__(self, dim: int = 1024, ngrams: range = range(3, 6)) -> None:
+        self.dim = dim
+        self.ngrams = ngrams
+        self.model = f"hashing-{dim}-{ngrams.start}-{ngrams.stop - 1}"
+
+    def _features(self, text: str) -> List[str]:
+        features = []
+        for word in text.lower().split():
+            features.append(word)
+            padded = f"<{word}>"
+            for n in self.ngrams:
+                features.extend(padded[i : i + n] for i in range(len(padded) - n + 1))
+        return features
+
+    def embed(self, texts: List[str], input_type: str) -> List[Embedding]:
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = zlib.crc32(feature.encode("utf-8"))
+                # Low bits pick the bucket, the top bit picks the sign so collisions tend to cancel out
+                embeddings[row, digest % self.dim] += 1.0 if digest >> 31 else -1.0
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return (embeddings / norms).tolist()
+
+
+PROVIDERS = {"voyage": VoyageProvider, "hashing": HashingProvider}
+
+
+def make_provider(name: str) -> EmbeddingProvider:
+    if name not in PROVIDERS:
+        raise ValueError(f"Unknown embedding provider {name}! Must be one of {list(PROVIDERS)}")
+    return PROVIDERS[name]()
+
+
+# Selected with the EMBEDDING_PROVIDER environment variable ("voyage" by default)
+provider: EmbeddingProvider = make_provider(os.environ.get("EMBEDDING_PROVIDER", "voyage"))
+
+# Selected with the EMBEDDING_CACHE_PATH environment variable, or configure(new_cache_path=...)
+cache_path = pathlib.Path(os.environ.get("EMBEDDING_CACHE_PATH", pathlib.Path(__file__).with_name("embedding_cache.sqlite")))
+cache_enabled = True
+# Opened on the first embed, so importing this module doesn't create the SQLite file
+cache: Optional[EmbeddingCache] = None
+_cache_lock = threading.Lock()
+
+
+def configure(new_provider: Optional[EmbeddingProvider] = None, new_cache: Optional[EmbeddingCache] = None, use_cache: bool = True, new_cache_path: Optional[pathlib.Path] = None) -> None:
+    """Swaps the provider and/or cache used by the embed_* functions, e.g. for tests and benchmarks"""
+    global provider, cache, cache_path, cache_enabled
+    if new_provider is not None:
+        provider = new_provider
+    if new_cache_path is not None:
+        # Reopened at the new path on the next embed
+        cache_path = pathlib.Path(new_cache_path)
+        cache = None
+    if new_cache is not None:
+        cache = new_cache
+    cache_enabled = use_cache
+    if not use_cache:
+        cache = None
+
+def get_cache() -> Optional[EmbeddingCache]:
+    global cache
+    if cache is None and cache_enabled:
+        # Saves embed on worker threads, so two could race to open it
+        with _cache_lock:
+            if cache is None and cache_enabled:
+                cache = EmbeddingCache(cache_path)
+    return cache
+
+def _embed(texts: List[str], input_type: str) -> List[Embedding]:
+    embedding_cache = get_cache()
+    if embedding_cache is None:
+        return provider.embed(texts, input_type=input_type)
+
+    # Everything that misses the cache goes out in a single request
+    embeddings = [embedding_cache.get(provider.model, input_type, text) for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+
+    if len(missing) > 0:
+        fresh = provider.embed([texts[i] for i in missing], input_type=input_type)
+        for i, embedding in zip(missing, fresh):
+            embedding_cache.put(provider.model, input_type, texts[i], embedding)
+            embeddings[i] = embedding
+    return embeddings
+
+def embed_memories(texts: List[str]) -> List[Embedding]:
+    return _embed(texts, input_type="document")
+
 def embed_memory(text: str) -> Embedding:
-    return vo.embed([text], model="voyage-3", input_type="document").embeddings[0]
+    return embed_memories([text])[0]
 
 def embed_query(text: str) -> Embedding:
-    return vo.embed([text], model="voyage-3", input_type="query").embeddings[0]
\ No newline at end of file
+    return _embed([text], input_type="query")[0]
@@ -0,0 +1,116 @@
+from typing import *
+
+import numpy as np
+
+# Below this many memories, brute force is fast enough and exact, so the index stays off
+ANN_MIN_SIZE = 10_000
+# Number of clusters searched per query. Higher means better recall and slower search.
+ANN_NPROBE = 8
+
+KMEANS_ITERATIONS = 10
+TRAIN_POINTS_PER_LIST = 64
+ASSIGN_CHUNK = 8192
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest-neighbour index over MemoryStore rows.
+
+    Embeddings are clustered with spherical k-means into ~sqrt(N) lists. Each
+    row remembers which list it belongs to, and a query only scores the rows
+    in its `nprobe` closest lists. Adds and deletes are O(1) and mirror the
+    store's row layout: deleted rows are tombstoned with list -1 until the
+    store compacts. The index retrains itself whenever the store has doubled
+    since the last training.
+    """
+
+    def __init__(self, nprobe: int = ANN_NPROBE, min_size: int = ANN_MIN_SIZE) -> None:
+        self.nprobe = nprobe
+        self.min_size = min_size
+        self.centroids: Optional[np.ndarray] = None
+        self.assignments = np.zeros(0, dtype=np.int32)
+        self.size = 0
+        self.trained_size = 0
+
+    @property
+    def active(self) -> bool:
+        return self.centroids is not None and self.size >= self.min_size
+
+    def _nearest(self, embeddings: np.ndarray) -> np.ndarray:
+        labels = np.empty(len(embeddings), dtype=np.int32)
+        for start in range(0, len(embeddings), ASSIGN_CHUNK):
+            chunk = embeddings[start : start + ASSIGN_CHUNK].astype(np.float32)
+            labels[start : start + ASSIGN_CHUNK] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return labels
+
+    def train(self, embeddings: np.ndarray, alive: np.ndarray, seed: int = 0) -> None:
+        live = np.flatnonzero(alive)
+        n_lists = max(1, int(np.sqrt(len(live))))
+        rng = np.random.default_rng(seed)
+
+        # Quantized rows are fine to cluster as-is: per-row scales don't change which centroid is closest
+        sample = embeddings[rng.choice(live, size=min(len(live), n_lists * TRAIN_POINTS_PER_LIST), replace=False)].astype(np.float32)
+        centroids = sample[rng.choice(len(sample), size=n_lists, replace=False)].copy()
+
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            order = np.argsort(labels, kind="stable")
+            counts = np.bincount(labels, minlength=n_lists)
+            nonempty = counts > 0
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+            # Empty clusters keep their previous centroid
+            centroids[nonempty] = np.add.reduceat(sample[order], starts, axis=0)
+            centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+
+        self.centroids = centroids.astype(np.float32)
+        self.assignments = self._nearest(embeddings)
+        self.assignments[~alive] = -1
+        self.size = len(embeddings)
+        self.trained_size = len(live)
+
+    def maybe_train(self, embeddings: np.ndarray, alive: np.ndarray) -> None:
+        live = int(np.count_nonzero(alive))
+        if live < self.min_size:
+            return
+        if self.centroids is None or live >= 2 * self.trained_size:
+            self.train(embeddings, alive)
+
+    def add(self, row: int, embedding: np.ndarray) -> None:
+        assert row == self.size, "Index is out of sync with the memory store"
+        if self.centroids is not None:
+            if row == len(self.assignments):
+                self.assignments = np.resize(self.assignments, max(64, 2 * row))
+            self.assignments[row] = self._nearest(embedding[None, :])[0]
+        self.size += 1
+
+    def remove(self, row: int) -> None:
+        # Mirrors MemoryStore.remove: the row is tombstoned, not moved
+        if self.centroids is not None:
+            self.assignments[row] = -1
+
+    def compact(self, keep: np.ndarray) -> None:
+        # Mirrors MemoryStore.compact. keep holds the old row index of every new row.
+        if self.centroids is not None:
+            self.assignments = self.assignments[keep]
+        self.size = len(keep)
+
+    def search(self, query: np.ndarray, limit: int = 1, nprobe: Optional[int] = None) -> Optional[np.ndarray]:
+        """Returns the candidate rows for a query, or None if the caller should do an exact search.
+
+        Probes at least `nprobe` lists, and further ones in order of closeness until there are `limit`
+        live candidates, since deletes can leave the closest lists (nearly) empty."""
+        if not self.active:
+            return None
+        nprobe = nprobe or self.nprobe
+        if nprobe >= len(self.centroids):
+            return None
+
+        assignments = self.assignments[: self.size]
+        order = np.argsort(-(self.centroids @ query))
+        counts = np.bincount(assignments[assignments >= 0], minlength=len(self.centroids))[order]
+        enough = np.flatnonzero(np.cumsum(counts) >= limit)
+        if len(enough) == 0:
+            return None
+        probes = max(nprobe, int(enough[0]) + 1)
+        if probes >= len(self.centroids):
+            return None
+        return np.flatnonzero(np.isin(assignments, order[:probes]))
@@ -0,0 +1,71 @@
+import math
+import re
+from collections import Counter
+from typing import *
+from uuid import UUID
+
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """Inverted index over memory contents with Okapi BM25 scoring, keyed by memory UUID.
+
+    Exact names, dates and numbers are where embeddings are weakest, and this
+    needs no embedding call at all. Adds and removes only touch the postings
+    of the terms in that one memory.
+    """
+
+    def __init__(self) -> None:
+        self.postings: Dict[str, Dict[UUID, int]] = {}
+        self.doc_terms: Dict[UUID, Counter] = {}
+        self.doc_lengths: Dict[UUID, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.doc_terms)
+
+    def add(self, uuid: UUID, text: str) -> None:
+        terms = Counter(tokenize(text))
+        self.doc_terms[uuid] = terms
+        self.doc_lengths[uuid] = sum(terms.values())
+        self.total_length += self.doc_lengths[uuid]
+        for term, count in terms.items():
+            self.postings.setdefault(term, {})[uuid] = count
+
+    def remove(self, uuid: UUID) -> None:
+        terms = self.doc_terms.pop(uuid, None)
+        if terms is None:
+            return
+        self.total_length -= self.doc_lengths.pop(uuid)
+        for term in terms:
+            posting = self.postings[term]
+            del posting[uuid]
+            if len(posting) == 0:
+                del self.postings[term]
+
+    def search(self, query: str, limit: Optional[int] = None) -> List[Tuple[UUID, float]]:
+        """(uuid, score) pairs for every memory sharing a term with the query, best first"""
+        if len(self.doc_terms) == 0:
+            return []
+        n = len(self.doc_terms)
+        average_length = self.total_length / n
+
+        scores: Dict[UUID, float] = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if posting is None:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            for uuid, count in posting.items():
+                norm = count + BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[uuid] / average_length)
+                scores[uuid] = scores.get(uuid, 0.0) + idf * count * (BM25_K1 + 1) / norm
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        return ranked if limit is None else ranked[:limit]
@@ -1,11 +1,12 @@
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Dict
-from uuid import uuid4, UUID
+from typing import Optional
+from uuid import UUID
 
 import numpy as np
 
-from .embedding import Embedding, embed_query, embed_memory
+from .embedding import Embedding, embed_query
+from .quantize import dot
 
 @dataclass
 class Memory:
@@ -15,25 +16,9 @@ class Memory:
     uuid: UUID
     importance: float
     
-def make_memory(text: str, importance: float) -> Memory:
-    embed = embed_memory(text)
-    return Memory(content=text, timestamp=datetime.now(), embedding=embed, uuid=uuid4(), importance=importance)
-    
-def relevance_scores(text: str, memories: List[Memory]) -> Dict[UUID, float]:
-    query_embed = embed_query(text)
-    scores = np.dot(np.array([m.embedding for m in memories]), np.array(query_embed))
-    return {memories[i].uuid: scores[i] for i in range(len(memories))}
+def query_embedding(text: str) -> np.ndarray:
+    return np.asarray(embed_query(text), dtype=np.float32)
 
-def time_score(memory: Memory) -> float:
-    start = datetime(year=2024, month=11, day=11, hour=19, minute=30)
-    total = datetime.now() - start
-    
-    span = memory.timestamp - start
-    
-    return span / total
-    
-if __name__ == "__main__":
-    m1 = make_memory("Pinapple apple banana pear", 0.0)
-    m2 = make_memory("Cars go vroom", 0.0)
-    
-    print(relevance_scores("Fruit", [m1, m2]))
\ No newline at end of file
+def relevance_scores(query_embed: np.ndarray, embeddings: np.ndarray, scales: Optional[np.ndarray] = None) -> np.ndarray:
+    # embeddings is an (N x D) matrix of MemoryStore rows, possibly quantized (see quantize.py); row i of the result scores row i
+    return dot(embeddings, scales, query_embed)
@@ -0,0 +1,45 @@
+from typing import *
+
+import numpy as np
+
+# How embeddings are held in memory and on disk:
+#   "float32": exact
+#   "float16": half the size, relative error ~1e-3
+#   "int8":    a quarter of the size, each row scaled so its largest component maps to 127
+EMBEDDING_DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+
+SCORE_CHUNK = 256
+
+
+def encode(embeddings: np.ndarray, dtype: str) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+    """Converts (N x D) float32 embeddings to the given dtype. Returns (codes, scales); scales is None unless int8."""
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(f"{dtype} is not a supported embedding dtype! Must be one of {list(EMBEDDING_DTYPES)}")
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if dtype != "int8":
+        return embeddings.astype(EMBEDDING_DTYPES[dtype]), None
+
+    scales = np.asarray(np.abs(embeddings).max(axis=-1) / 127.0)
+    scales[scales == 0] = 1.0
+    codes = np.rint(embeddings / scales[..., None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def decode(codes: np.ndarray, scales: Optional[np.ndarray]) -> np.ndarray:
+    embeddings = codes.astype(np.float32)
+    if scales is not None:
+        embeddings *= np.asarray(scales, dtype=np.float32)[..., None]
+    return embeddings
+
+
+def dot(codes: np.ndarray, scales: Optional[np.ndarray], query: np.ndarray) -> np.ndarray:
+    """codes @ query without materializing a float32 copy of the whole matrix"""
+    if codes.dtype == np.float32:
+        return codes @ query
+
+    scores = np.empty(len(codes), dtype=np.float32)
+    for start in range(0, len(codes), SCORE_CHUNK):
+        scores[start : start + SCORE_CHUNK] = codes[start : start + SCORE_CHUNK].astype(np.float32) @ query
+    if scales is not None:
+        scores *= scales
+    return scores
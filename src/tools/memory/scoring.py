@@ -0,0 +1,34 @@
+import time
+from datetime import datetime
+
+import numpy as np
+
+IMPORTANCE_WEIGHT = 0.1
+RECENCY_WEIGHT = 0.2
+RELEVANCE_WEIGHT = 1.0
+
+# Recency is measured as the fraction of time elapsed between this date and now
+RECENCY_START = datetime(year=2024, month=11, day=11, hour=19, minute=30).timestamp()
+
+
+def time_scores(timestamps: np.ndarray) -> np.ndarray:
+    return (timestamps - RECENCY_START) / (time.time() - RECENCY_START)
+
+
+def combined_scores(importances: np.ndarray, timestamps: np.ndarray, relevances: np.ndarray) -> np.ndarray:
+    return (
+        (IMPORTANCE_WEIGHT * importances)
+        + (RECENCY_WEIGHT * time_scores(timestamps))
+        + (RELEVANCE_WEIGHT * relevances)
+    )
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the k highest scores, best first. Only the top k get fully sorted."""
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    if k < len(scores):
+        top = np.argpartition(-scores, k - 1)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind="stable")]
@@ -0,0 +1,155 @@
+import pathlib
+import pickle as pkl
+import sqlite3
+from typing import *
+from uuid import UUID
+
+import numpy as np
+
+from .memory import Memory
+from .quantize import EMBEDDING_DTYPES, decode, encode
+from .store import MemoryStore
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS memories (
+    uuid TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    importance REAL NOT NULL,
+    embedding BLOB NOT NULL,
+    encoding TEXT NOT NULL DEFAULT 'float32',
+    scale REAL
+)
+"""
+
+META_SCHEMA = "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+
+# Every memory written before the embedding model was recorded used this one
+LEGACY_EMBEDDING_MODEL = "voyage-3"
+
+# Columns added after the first version of the schema, for upgrading existing databases
+ADDED_COLUMNS = {
+    "encoding": "TEXT NOT NULL DEFAULT 'float32'",
+    "scale": "REAL",
+}
+
+INSERT = "INSERT INTO memories (uuid, content, timestamp, importance, embedding, encoding, scale) VALUES (?, ?, ?, ?, ?, ?, ?)"
+
+
+class MemoryDB:
+    """SQLite persistence for memories, one row per memory.
+
+    Each write() applies a batch of inserts, updates and deletes in one
+    transaction, so it costs O(k) for k rows whatever the size of the DB, and a
+    crash never leaves half a batch behind. Embeddings are stored as raw bytes
+    in the store's dtype (`encoding` column), with the per-row `scale` for int8.
+    """
+
+    def __init__(self, path: pathlib.Path, legacy_path: Optional[pathlib.Path] = None, dtype: str = "float32") -> None:
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"{dtype} is not a supported embedding dtype! Must be one of {list(EMBEDDING_DTYPES)}")
+        self.path = path
+        self.dtype = dtype
+        # Used from MemoryTool's save workers too; MemoryTool serializes access
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(SCHEMA)
+            self.conn.execute(META_SCHEMA)
+            existing = {row[1] for row in self.conn.execute("PRAGMA table_info(memories)")}
+            for column, definition in ADDED_COLUMNS.items():
+                if column not in existing:
+                    self.conn.execute(f"ALTER TABLE memories ADD COLUMN {column} {definition}")
+
+        if legacy_path is not None and legacy_path.exists():
+            self._migrate_pickle(legacy_path)
+
+    def _migrate_pickle(self, legacy_path: pathlib.Path) -> None:
+        """One-time import of the old memories.pkl. The pickle is renamed afterwards so this never runs twice."""
+        with open(legacy_path, "rb") as f:
+            try:
+                memories: List[Memory] = pkl.load(f)
+            except EOFError:
+                memories = []
+
+        with self.conn:
+            self.conn.executemany(
+                INSERT.replace("INSERT", "INSERT OR IGNORE", 1),
+                [self._row(memory) for memory in memories],
+            )
+        legacy_path.rename(legacy_path.with_name(legacy_path.name + ".migrated"))
+
+    def check_model(self, model: str) -> None:
+        """Records the embedding model, and refuses to mix embeddings from different models in one DB"""
+        count = self.conn.execute("SELECT COUNT(*) FROM memories").fetchone()[0]
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'embedding_model'").fetchone()
+        stored = row[0] if row is not None else (LEGACY_EMBEDDING_MODEL if count > 0 else None)
+
+        if stored is not None and stored != model and count > 0:
+            raise ValueError(
+                f"{self.path} holds {count} memories embedded with {stored}, but the embedding provider is {model}. "
+                "Use the same provider, or a different database."
+            )
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('embedding_model', ?)", (model,))
+
+    def _row(self, memory: Memory) -> Tuple:
+        codes, scale = encode(memory.embedding, self.dtype)
+        return (
+            str(memory.uuid),
+            memory.content,
+            memory.timestamp.timestamp(),
+            float(memory.importance),
+            codes.tobytes(),
+            self.dtype,
+            None if scale is None else float(scale),
+        )
+
+    def load(self) -> MemoryStore:
+        rows = self.conn.execute(
+            "SELECT uuid, content, timestamp, importance, embedding, encoding, scale FROM memories ORDER BY rowid"
+        ).fetchall()
+        if len(rows) == 0:
+            return MemoryStore(dtype=self.dtype)
+
+        uuids, contents, timestamps, importances, blobs, encodings, scales = zip(*rows)
+        if all(encoding == self.dtype for encoding in encodings):
+            # Fast path: the blobs are already in the store's layout
+            embeddings = np.frombuffer(b"".join(blobs), dtype=EMBEDDING_DTYPES[self.dtype]).reshape(len(rows), -1)
+            scales = np.array(scales, dtype=np.float32) if self.dtype == "int8" else None
+        else:
+            # The dtype was changed since some rows were written. Decode row by row; the store re-encodes.
+            embeddings = np.stack([
+                decode(np.frombuffer(blob, dtype=EMBEDDING_DTYPES[encoding]), scale)
+                for blob, encoding, scale in zip(blobs, encodings, scales)
+            ])
+            scales = None
+
+        return MemoryStore.from_columns(
+            embeddings=embeddings,
+            timestamps=np.array(timestamps, dtype=np.float64),
+            importances=np.array(importances, dtype=np.float64),
+            uuids=[UUID(uuid) for uuid in uuids],
+            contents=list(contents),
+            dtype=self.dtype,
+            scales=scales,
+        )
+
+    def write(
+        self,
+        inserts: Sequence[Memory] = (),
+        updates: Sequence[Tuple[UUID, float, float]] = (),
+        deletes: Sequence[UUID] = (),
+    ) -> None:
+        """Inserts new memories, updates (uuid, importance, timestamp) of existing ones and deletes others, in one transaction"""
+        with self.conn:
+            self.conn.executemany(INSERT, [self._row(memory) for memory in inserts])
+            self.conn.executemany(
+                "UPDATE memories SET importance = ?, timestamp = ? WHERE uuid = ?",
+                [(importance, timestamp, str(uuid)) for uuid, importance, timestamp in updates],
+            )
+            self.conn.executemany("DELETE FROM memories WHERE uuid = ?", [(str(uuid),) for uuid in deletes])
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,204 @@
+from datetime import datetime
+from typing import *
+from uuid import UUID
+
+import numpy as np
+
+from .memory import Memory
+from .quantize import EMBEDDING_DTYPES, decode, encode
+
+INITIAL_CAPACITY = 64
+
+# Compact once tombstones make up this fraction of the rows (and there are at least COMPACT_MIN_DELETED)
+COMPACT_FRACTION = 0.25
+COMPACT_MIN_DELETED = 64
+
+
+class MemoryStore:
+    """Columnar in-memory storage for memories.
+
+    Row i of every array belongs to the same memory. Embeddings live in one
+    contiguous (N x D) matrix, float32 by default, so scoring never has to rebuild it from
+    Python lists, and `Memory` objects are only built for the rows that
+    actually get rendered. With `dtype="float16"` or `"int8"` the matrix is
+    kept quantized (int8 with a per-row scale), see quantize.py.
+
+    Rows are found by UUID through a dict, and deleting only tombstones the
+    row (`alive[row] = False`). Dead rows stay in the arrays until `compact`
+    squeezes them out, so callers scoring the arrays must respect `alive`.
+    """
+
+    def __init__(self, capacity: int = INITIAL_CAPACITY, dtype: str = "float32") -> None:
+        if dtype not in EMBEDDING_DTYPES:
+            raise ValueError(f"{dtype} is not a supported embedding dtype! Must be one of {list(EMBEDDING_DTYPES)}")
+        self.dtype = dtype
+        self.size = 0  # Rows in use, including tombstones
+        self.deleted = 0
+        self.dim: Optional[int] = None
+        self._embeddings = np.zeros((capacity, 0), dtype=EMBEDDING_DTYPES[dtype])
+        self._scales = np.ones(capacity, dtype=np.float32)
+        self._timestamps = np.zeros(capacity, dtype=np.float64)
+        self._importances = np.zeros(capacity, dtype=np.float64)
+        self._alive = np.zeros(capacity, dtype=bool)
+        self.uuids: List[Optional[UUID]] = []
+        self.contents: List[Optional[str]] = []
+        self.rows: Dict[UUID, int] = {}
+
+    def __len__(self) -> int:
+        # Number of live memories
+        return self.size - self.deleted
+
+    @classmethod
+    def from_columns(
+        cls,
+        embeddings: np.ndarray,
+        timestamps: np.ndarray,
+        importances: np.ndarray,
+        uuids: List[UUID],
+        contents: List[str],
+        dtype: str = "float32",
+        scales: Optional[np.ndarray] = None,
+    ) -> "MemoryStore":
+        """Builds a store straight from column arrays, without going through Memory objects.
+
+        embeddings are float32, unless scales is given, in which case they are already int8 codes.
+        """
+        size = len(uuids)
+        store = cls(capacity=max(INITIAL_CAPACITY, size), dtype=dtype)
+        store.dim = embeddings.shape[1]
+        store._embeddings = np.zeros((len(store._timestamps), store.dim), dtype=EMBEDDING_DTYPES[dtype])
+        if embeddings.dtype != EMBEDDING_DTYPES[dtype]:
+            embeddings, scales = encode(embeddings, dtype)
+        store._embeddings[:size] = embeddings
+        if scales is not None:
+            store._scales[:size] = scales
+        store._timestamps[:size] = timestamps
+        store._importances[:size] = importances
+        store._alive[:size] = True
+        store.uuids = list(uuids)
+        store.contents = list(contents)
+        store.rows = {uuid: row for row, uuid in enumerate(store.uuids)}
+        store.size = size
+        return store
+
+    # Views over the used rows (tombstones included). These are not copies, so don't hold onto them across writes.
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self._embeddings[: self.size]
+
+    @property
+    def scales(self) -> Optional[np.ndarray]:
+        # Per-row scale for int8 codes, None for float dtypes
+        return self._scales[: self.size] if self.dtype == "int8" else None
+
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._timestamps[: self.size]
+
+    @property
+    def importances(self) -> np.ndarray:
+        return self._importances[: self.size]
+
+    @property
+    def alive(self) -> np.ndarray:
+        return self._alive[: self.size]
+
+    def live_rows(self) -> np.ndarray:
+        return np.flatnonzero(self.alive)
+
+    def _grow(self, capacity: int) -> None:
+        embeddings = np.zeros((capacity, self.dim), dtype=self._embeddings.dtype)
+        embeddings[: self.size] = self.embeddings
+        self._embeddings = embeddings
+        self._scales = np.resize(self._scales, capacity)
+        self._timestamps = np.resize(self._timestamps, capacity)
+        self._importances = np.resize(self._importances, capacity)
+        alive = np.zeros(capacity, dtype=bool)
+        alive[: self.size] = self.alive
+        self._alive = alive
+
+    def append(self, memory: Memory) -> int:
+        """Adds a memory as a new row and returns its row index"""
+        embedding = np.asarray(memory.embedding, dtype=np.float32)
+
+        if self.dim is None:
+            self.dim = embedding.shape[0]
+            self._embeddings = np.zeros((len(self._timestamps), self.dim), dtype=EMBEDDING_DTYPES[self.dtype])
+        elif embedding.shape[0] != self.dim:
+            raise ValueError(f"Embedding has dimension {embedding.shape[0]}, expected {self.dim}")
+
+        if self.size == len(self._timestamps):
+            self._grow(max(INITIAL_CAPACITY, 2 * self.size))
+
+        row = self.size
+        codes, scale = encode(embedding, self.dtype)
+        self._embeddings[row] = codes
+        if scale is not None:
+            self._scales[row] = scale
+        self._timestamps[row] = memory.timestamp.timestamp()
+        self._importances[row] = memory.importance
+        self._alive[row] = True
+        self.uuids.append(memory.uuid)
+        self.contents.append(memory.content)
+        self.rows[memory.uuid] = row
+        self.size += 1
+        return row
+
+    def update(self, row: int, importance: float, timestamp: float) -> None:
+        self._importances[row] = importance
+        self._timestamps[row] = timestamp
+
+    def find(self, uuid: UUID) -> Optional[int]:
+        return self.rows.get(uuid)
+
+    def remove(self, uuid: UUID) -> Optional[int]:
+        """Tombstones a memory in O(1). Returns the row it occupied, or None if it wasn't stored."""
+        row = self.rows.pop(uuid, None)
+        if row is None:
+            return None
+        self._alive[row] = False
+        self.uuids[row] = None
+        self.contents[row] = None
+        self.deleted += 1
+        return row
+
+    @property
+    def needs_compaction(self) -> bool:
+        return self.deleted >= COMPACT_MIN_DELETED and self.deleted >= COMPACT_FRACTION * self.size
+
+    def compact(self) -> np.ndarray:
+        """Squeezes out tombstoned rows, keeping the order of live rows.
+
+        Returns the old row index of every new row, so anything keyed by row (like the ANN index) can follow along.
+        """
+        keep = self.live_rows()
+        size = len(keep)
+        self._embeddings[:size] = self._embeddings[keep]
+        self._scales[:size] = self._scales[keep]
+        self._timestamps[:size] = self._timestamps[keep]
+        self._importances[:size] = self._importances[keep]
+        self._alive[:size] = True
+        self._alive[size:] = False
+        self.uuids = [self.uuids[row] for row in keep]
+        self.contents = [self.contents[row] for row in keep]
+        self.rows = {uuid: row for row, uuid in enumerate(self.uuids)}
+        self.size = size
+        self.deleted = 0
+        return keep
+
+    def embedding(self, row: int) -> np.ndarray:
+        # Dequantized float32 embedding of a row
+        return decode(self._embeddings[row], self._scales[row] if self.dtype == "int8" else None)
+
+    def memory(self, row: int) -> Memory:
+        # For rendering, which never reads the embedding, so it's left empty (like a pending save's). See embedding(row).
+        return Memory(
+            content=self.contents[row],
+            timestamp=datetime.fromtimestamp(self._timestamps[row]),
+            embedding=[],
+            uuid=self.uuids[row],
+            importance=float(self._importances[row]),
+        )
+
+    def memories(self, rows: Iterable[int]) -> List[Memory]:
+        return [self.memory(row) for row in rows]
@@ -1,21 +1,64 @@
 from .memory import Memory
 from datetime import datetime
 from typing import *
-from uuid import UUID
-
-def make_xml_once(memory: Memory, relevance: float) -> str:
-    return f'<memory id="{memory.uuid}" date="{timestamp(memory.timestamp)}" relevance={relevance:.3f}" importance="{memory.importance}">\n\t{memory.content}\n</memory>'
-
-def make_xml(sorted_memories: List[Memory], relevances: Dict[UUID, float]) -> str:
-    text = '<system type="memory_load">'
-    
-    for memory in sorted_memories:
-        rel = relevances[memory.uuid]
-        text += make_xml_once(memory=memory, relevance=rel)
-    
-    text += '</system>'
-    
-    return text
+
+# Rough size of a token in characters, close enough for English text
+CHARS_PER_TOKEN = 4
+# Longer memory bodies are cut short, so one huge memory can't crowd out the rest
+MAX_MEMORY_CHARS = 2000
+# Don't bother rendering a memory cut to less than this to fit the budget
+MIN_MEMORY_CHARS = 200
+TRUNCATION_MARKER = " [...truncated]"
+
+HEADER = '<system type="memory_load">'
+FOOTER = '</system>'
+
+def make_xml_once(memory: Memory, relevance: Optional[float], content: Optional[str] = None) -> str:
+    content = memory.content if content is None else content
+    relevance = "" if relevance is None else f' relevance="{relevance:.3f}"'
+    return f'<memory id="{memory.uuid}" date="{timestamp(memory.timestamp)}"{relevance} importance="{memory.importance}">\n\t{content}\n</memory>'
+
+def truncate(content: str, max_chars: int) -> str:
+    if len(content) <= max_chars:
+        return content
+    return content[:max(0, max_chars - len(TRUNCATION_MARKER))] + TRUNCATION_MARKER
+
+def omitted_xml(count: int) -> str:
+    return f'<omitted count="{count}">Over the memory_load budget. Raise max_tokens or narrow the query to see them.</omitted>'
+
+def budget_chars(max_tokens: Optional[int], max_chars: Optional[int]) -> Optional[int]:
+    budgets = [budget for budget in (max_chars, None if max_tokens is None else max_tokens * CHARS_PER_TOKEN) if budget is not None]
+    return min(budgets) if len(budgets) > 0 else None
+
+def make_xml(sorted_memories: Sequence[Memory], relevances: Optional[Sequence[float]], max_tokens: Optional[int] = None, max_chars: Optional[int] = None) -> str:
+    """Renders memories best first until the budget runs out. Whatever doesn't fit is reported as an <omitted> count."""
+    # relevances is parallel to sorted_memories, or None if no query was scored (date sort)
+    if relevances is None:
+        relevances = [None] * len(sorted_memories)
+    budget = budget_chars(max_tokens, max_chars)
+
+    parts = [HEADER]
+    # Room for the footer and the omitted note is held back from the start
+    used = len(HEADER) + len(FOOTER) + len(omitted_xml(len(sorted_memories)))
+    rendered = 0
+    for memory, rel in zip(sorted_memories, relevances):
+        content = truncate(memory.content, MAX_MEMORY_CHARS)
+        entry = make_xml_once(memory=memory, relevance=rel, content=content)
+        if budget is not None and used + len(entry) > budget:
+            # Cut the body down to whatever room is left, if that's still worth reading
+            room = budget - used - (len(entry) - len(content))
+            if room < MIN_MEMORY_CHARS:
+                break
+            entry = make_xml_once(memory=memory, relevance=rel, content=truncate(content, room))
+        parts.append(entry)
+        used += len(entry)
+        rendered += 1
+
+    if rendered < len(sorted_memories):
+        parts.append(omitted_xml(len(sorted_memories) - rendered))
+    parts.append(FOOTER)
+
+    return "".join(parts)
 
 def timestamp(dt: datetime) -> str:
-    return f"{dt.month} {dt.day} {dt.year} ({dt.hour}:{dt.minute})"
\ No newline at end of file
+    return f"{dt.month} {dt.day} {dt.year} ({dt.hour}:{dt.minute})"
@@ -1,16 +1,26 @@
 # NB: This Code was mostly generated by Claude
 
-from src.api import Conversation, Channel
+from src.api import Conversation, Channel, chat_log_dir
 from src.utils import get_raw_text, ROOT
 from src.scaffolding.xml_parser import parse_claude_output, ParsedTag
+from src.scaffolding.chat_log import latest_log
+from src.scaffolding.metrics import metrics
 
+import argparse
 import curses
+import pathlib
 import textwrap
 import signal
 import os
 import time
+import re
 from curses.textpad import rectangle
-from typing import List, Tuple
+from typing import Iterator, List, Optional, Tuple
+
+# Minimum seconds between redraws while a response streams in
+STREAM_RENDER_INTERVAL = 0.05
+# An opened <response> tag, up to its closing tag or the end of the text so far
+RESPONSE_PATTERN = re.compile(r"<response[^>]*>(.*?)(?:</response>|$)", re.DOTALL)
 
 class EnhancedTextbox:
     def __init__(self, win):
@@ -421,6 +431,39 @@ class ChatTUI:
         except curses.error:
             pass
 
+    def scroll_chat_to_bottom(self):
+        formatted_lines = self.format_chat_history()
+        self.chat_scroll = max(
+            0, len(formatted_lines) - (self.usable_height - 4)
+        )
+
+    def stream_response(self, deltas: Iterator[str]) -> str:
+        """Shows a response in the Chat History and Raw Output panes as it arrives, and returns the full text"""
+        text = ""
+        self.chat_history.append("Claude: ...")
+        last_render = 0.0
+        for delta in deltas:
+            text += delta
+            # Re-wrapping the panes on every delta would cost more than the stream itself
+            if time.time() - last_render < STREAM_RENDER_INTERVAL:
+                continue
+            last_render = time.time()
+            self.render_partial(text)
+        self.render_partial(text)
+        
+        # The caller adds the parsed response in its place
+        self.chat_history.pop()
+        return text
+
+    def render_partial(self, text: str):
+        response = partial_response(text)
+        self.chat_history[-1] = f"Claude: {response if response else '...'}"
+        self.raw_content = text
+        self.raw_scroll = max(0, len(textwrap.fill(text, self.side_width - 2).split("\n")) - self.raw_height)
+        self.scroll_chat_to_bottom()
+        self.update_chat_window()
+        self.update_raw_window()
+
     def run(self):
         while True:
             try:
@@ -442,26 +485,36 @@ class ChatTUI:
                 user_input = self.textbox.get_value()
                 if not user_input.strip():
                     continue
+                
+                # Local command, never sent to the model
+                if user_input.strip() == "/metrics":
+                    self.chat_history.append(metrics.report())
+                    self.chat_history.append(self.conversation.tool_server.result_cache.report())
+                    self.scroll_chat_to_bottom()
+                    self.update_chat_window()
+                    continue
 
                 self.chat_history.append(f"You: {user_input.strip()}")
+                self.scroll_chat_to_bottom()
+                self.update_chat_window()
+                
+                output = self.stream_response(self.conversation.query_stream(user_input, channel=Channel.CHAT))
                 tool_calls, response, raw, tools = get_chat_result(
-                    self.conversation, user_input
+                    self.conversation, output
                 )
                 if response is not None:
                     self.chat_history.append(f"Claude: {response}")
                 self.raw_content = raw
                 self.tool_calls_content = tool_calls
 
-                formatted_lines = self.format_chat_history()
-                self.chat_scroll = max(
-                    0, len(formatted_lines) - (self.usable_height - 4)
-                )
+                self.scroll_chat_to_bottom()
                 self.update_chat_window()
                 self.update_raw_window()
                 self.update_tool_calls_window()
                 
-                tool_output = self.conversation.use_tools(tools)
-                while tool_output is not None:
+                deltas = self.conversation.use_tools_stream(tools)
+                while deltas is not None:
+                    tool_output = self.stream_response(deltas)
                     
                     # Parse the response to tool data
                     tags, response = parse_claude_output(tool_output)
@@ -471,15 +524,16 @@ class ChatTUI:
                     self.tool_calls_content = tools_to_str(tags)
                     
                     # Update the windows
+                    self.scroll_chat_to_bottom()
                     self.update_chat_window()
                     self.update_raw_window()
                     self.update_tool_calls_window()
                     
                     # Try to once again respond to calls
-                    if tags is not []:
-                        tool_output = self.conversation.use_tools(tags)
+                    if len(tags) > 0:
+                        deltas = self.conversation.use_tools_stream(tags)
                     else:
-                        tool_output = None
+                        deltas = None
                     
 
             except KeyboardInterrupt:
@@ -489,9 +543,8 @@ class ChatTUI:
 
 
 def get_chat_result(
-    conversation: Conversation, user_input: str
+    conversation: Conversation, output: str
 ) -> Tuple[str, str, str, List[ParsedTag]]:
-    output = conversation.query(user_input, channel=Channel.CHAT)
     assistant_block = conversation.last_assistant_block()
     raw_text = get_raw_text(assistant_block)
 
@@ -501,6 +554,12 @@ def get_chat_result(
 
     return tools_to_str(tags), response, raw_text, tags
 
+def partial_response(text: str) -> str:
+    """The <response> text of a message that may still be generating"""
+    return "\n".join(
+        match.group(1).strip() for match in RESPONSE_PATTERN.finditer(text)
+    )
+
 def tools_to_str(tags: List[ParsedTag]) -> str:
     tool_calls = ""
 
@@ -510,17 +569,33 @@ def tools_to_str(tags: List[ParsedTag]) -> str:
         
     return tool_calls
 
-def main(stdscr) -> Conversation:
+def main(stdscr, resume_from: Optional[pathlib.Path] = None) -> Conversation:
     curses.curs_set(1)
     stdscr.timeout(-1)
 
-    conversation = Conversation(with_system_prompt=True)
+    conversation = Conversation(with_system_prompt=True, resume_from=resume_from)
     chat_tui = ChatTUI(stdscr, conversation)
+    if resume_from is not None:
+        chat_tui.chat_history.append(f"(Resumed {len(conversation.messages)} messages from {resume_from.name})")
+        chat_tui.update_chat_window()
     try:
         chat_tui.run()
     finally:
         signal.signal(signal.SIGWINCH, signal.SIG_DFL)
+        conversation.close()
 
 
 if __name__ == "__main__":
-    curses.wrapper(main)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resume", nargs="?", const="latest", help="continue a logged session (the most recent one if no path is given)")
+    args = parser.parse_args()
+    
+    resume_from = None
+    if args.resume == "latest":
+        resume_from = latest_log(chat_log_dir)
+        if resume_from is None:
+            parser.error(f"No sessions to resume in {chat_log_dir}")
+    elif args.resume is not None:
+        resume_from = pathlib.Path(args.resume)
+        
+    curses.wrapper(main, resume_from)